@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ShuGenAI.settings")
 
 application = get_asgi_application()
+
+from utilities import startup  # noqa: E402, the apps have to be loaded first
+
+startup.warm_up()
@@ -181,6 +181,10 @@ REST_FRAMEWORK = {
 MEDIA_URL = '/media/'  # Or a complete URL if using a CDN
 MEDIA_ROOT = BASE_DIR / 'media'  # Adjust as needed
 
+# Scratch space for conversions; large uploads are spooled here by Django as well
+TMP_DIR = BASE_DIR.parent / 'tmp'
+FILE_UPLOAD_TEMP_DIR = TMP_DIR
+
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [
     BASE_DIR / "static",  # Optional: If you have a global static directory
@@ -189,3 +193,87 @@ STATICFILES_DIRS = [
 CORS_ALLOW_ALL_ORIGINS = True
 
 USE_MOCK_OUTPUT = (os.environ.get("USE_MOCK_OUTPUT", "True") == "True")
+
+# Largest image the image features decode (width x height), checked from the header; larger ones get a 413
+IMAGE_MAX_PIXELS = int(os.environ.get("IMAGE_MAX_PIXELS", 120_000_000))
+# Bytes an image may take once decoded; larger inputs get a 413. With allow_downscale=true, JPEG,
+# uncompressed TIFF and RAW inputs are decoded at a lower resolution to fit instead (see
+# utilities/image_utils.py). Full resolution processing by tiles is not provided. With the defaults
+# only RAW inputs above ~71 megapixels can exceed it, the others are refused by IMAGE_MAX_PIXELS first.
+IMAGE_MEMORY_BUDGET = int(os.environ.get("IMAGE_MEMORY_BUDGET", 1024 ** 3))
+
+# Decoded stock and uploaded backgrounds of edit_background kept in process, with their resized variants
+BACKGROUND_CACHE_MAX_BYTES = int(os.environ.get("BACKGROUND_CACHE_MAX_BYTES", 512 * 1024 ** 2))
+# Longest side the backgrounds are decoded at; larger outputs get an upscaled background
+BACKGROUND_MAX_DIMENSION = int(os.environ.get("BACKGROUND_MAX_DIMENSION", 4096))
+# Decode the stock backgrounds when the server process starts rather than on first use
+BACKGROUND_PRELOAD = (os.environ.get("BACKGROUND_PRELOAD", "True") == "True")
+
+# AI models (see utilities/ai_models.py) are loaded on first use; the ones listed here, out of
+# "segmentation" and "inpainting", are loaded when the server process starts instead
+AI_MODELS_WARM_UP = [name for name in os.environ.get("AI_MODELS_WARM_UP", "").split(",") if name]
+
+# Asynchronous feature jobs (see `manage.py run_feature_jobs`)
+FEATURE_JOB_WORKERS = int(os.environ.get("FEATURE_JOB_WORKERS", 2))
+FEATURE_JOB_POLL_INTERVAL = float(os.environ.get("FEATURE_JOB_POLL_INTERVAL", 1))
+# Seconds between the heartbeats of the running jobs; a job without one for FEATURE_JOB_STALE_AFTER
+# seconds lost its worker and is queued again, or failed once it has been started FEATURE_JOB_MAX_ATTEMPTS times
+FEATURE_JOB_HEARTBEAT_INTERVAL = float(os.environ.get("FEATURE_JOB_HEARTBEAT_INTERVAL", 30))
+FEATURE_JOB_STALE_AFTER = int(os.environ.get("FEATURE_JOB_STALE_AFTER", 5 * 60))
+FEATURE_JOB_MAX_ATTEMPTS = int(os.environ.get("FEATURE_JOB_MAX_ATTEMPTS", 3))
+
+# Content-addressed cache of feature outputs
+FEATURE_CACHE_ENABLED = (os.environ.get("FEATURE_CACHE_ENABLED", "True") == "True")
+FEATURE_CACHE_MAX_AGE = int(os.environ.get("FEATURE_CACHE_MAX_AGE", 7 * 24 * 60 * 60))  # seconds
+FEATURE_CACHE_MAX_BYTES = int(os.environ.get("FEATURE_CACHE_MAX_BYTES", 5 * 1024 ** 3))
+# Seconds between two evictions in a process that stored results, done by a background thread;
+# 0 evicts in the request after every store. `manage.py purge_history` evicts as well
+FEATURE_CACHE_EVICT_INTERVAL = float(os.environ.get("FEATURE_CACHE_EVICT_INTERVAL", 60))
+# Seconds between two sums of the cache size; in between, a process only counts its own stores
+# and evictions, the cache may go over FEATURE_CACHE_MAX_BYTES by what the other ones stored
+FEATURE_CACHE_SIZE_RESYNC_INTERVAL = float(os.environ.get("FEATURE_CACHE_SIZE_RESYNC_INTERVAL", 60 * 60))
+# Non-deterministic features (LLM text generation, diffusion inpainting) are never cached
+FEATURE_CACHE_EXCLUDED_KEYS = [
+    "generate_summary", "rewrite_text", "essay_writer", "paragraph_writer",
+    "grammar_checker", "post_writer", "document_code", "cut_out_object",
+]
+
+# Concurrent executions allowed per feature cost class on one host (see features/admission.py).
+# "wait" is how long a request queues for a free slot before it gets a 429 with "retry_after" seconds.
+FEATURE_CONCURRENCY_LIMITS = {
+    "gpu": {"limit": int(os.environ.get("GPU_FEATURE_CONCURRENCY", 1)), "wait": 30, "retry_after": 10},
+    "video": {"limit": int(os.environ.get("VIDEO_FEATURE_CONCURRENCY", 2)), "wait": 0, "retry_after": 30},
+    "document": {"limit": int(os.environ.get("DOCUMENT_FEATURE_CONCURRENCY", 4)), "wait": 10, "retry_after": 5},
+    "image": {"limit": int(os.environ.get("IMAGE_FEATURE_CONCURRENCY", 8)), "wait": 10, "retry_after": 1},
+    "llm": {"limit": int(os.environ.get("LLM_FEATURE_CONCURRENCY", 32)), "wait": 10, "retry_after": 2},
+}
+
+# Seconds a user's allowed feature keys are cached in process; subscription and plan changes
+# made through the ORM invalidate them right away in the process that made them
+FEATURE_ENTITLEMENT_CACHE_TTL = int(os.environ.get("FEATURE_ENTITLEMENT_CACHE_TTL", 60))
+
+# Seconds between two writes of the buffered Feature.used_count and FeatureUsageRollup increments,
+# 0 writes every use right away
+FEATURE_USAGE_FLUSH_INTERVAL = float(os.environ.get("FEATURE_USAGE_FLUSH_INTERVAL", 5))
+
+# Write-behind History: rows are journaled to TMP_DIR/history_journal and bulk inserted in the background
+FEATURE_HISTORY_WRITE_BEHIND = (os.environ.get("FEATURE_HISTORY_WRITE_BEHIND", "False") == "True")
+FEATURE_HISTORY_FLUSH_INTERVAL = float(os.environ.get("FEATURE_HISTORY_FLUSH_INTERVAL", 1))
+FEATURE_HISTORY_BATCH_SIZE = int(os.environ.get("FEATURE_HISTORY_BATCH_SIZE", 500))
+
+# Retention of History rows and their files (see `manage.py purge_history`); Feature.retention_days
+# overrides it per feature, 0 keeps the history forever
+FEATURE_HISTORY_RETENTION_DAYS = int(os.environ.get("FEATURE_HISTORY_RETENTION_DAYS", 0))
+# Files younger than this (seconds) are never swept, their rows may not be written yet
+FEATURE_MEDIA_GC_GRACE_PERIOD = int(os.environ.get("FEATURE_MEDIA_GC_GRACE_PERIOD", 24 * 60 * 60))
+# Seconds the segmented previews of the object pickers are kept
+FEATURE_SEGMENTED_IMAGE_MAX_AGE = int(os.environ.get("FEATURE_SEGMENTED_IMAGE_MAX_AGE", 24 * 60 * 60))
+
+# Access to the Prometheus metrics at /utils/metrics/: a scraper sending "Authorization: Bearer <METRICS_TOKEN>",
+# or one connecting from METRICS_ALLOWED_IPS (the proxy's address when the app runs behind one).
+# The histograms are kept in the memory of each server process and cover its own requests only:
+# with several workers every one of them has to be scraped, a scrape through the load balancer
+# sees a different worker each time.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+METRICS_ALLOWED_IPS = [ip.strip() for ip in os.environ.get("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",")
+                       if ip.strip()]
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ShuGenAI.settings")
 
 application = get_wsgi_application()
+
+from utilities import startup  # noqa: E402, the apps have to be loaded first
+
+startup.warm_up()
@@ -1,8 +1,13 @@
 from django.contrib import admin
-from .models import Feature, Plans, Subscription, History
+from .models import (Feature, Plans, Subscription, History, FeatureJob, CachedResult, FeatureUsageRollup,
+                     RecentFeature)
 
 # Register your models here.
 admin.site.register(Feature)
 admin.site.register(Plans)
 admin.site.register(Subscription)
-admin.site.register(History)
\ No newline at end of file
+admin.site.register(History)
+admin.site.register(FeatureJob)
+admin.site.register(CachedResult)
+admin.site.register(FeatureUsageRollup)
+admin.site.register(RecentFeature)
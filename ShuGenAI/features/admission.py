@@ -0,0 +1,135 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+from django.http import JsonResponse
+from rest_framework import status
+from utilities import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines
+    fcntl = None
+
+# Features grouped by the resource they exhaust; anything not listed is a lightweight image operation
+FEATURE_COST_CLASSES = {
+    "gpu": ["remove_background", "edit_background", "pick_up_object", "cut_out_object"],
+    "video": ["mp4_to_gif", "mkv_to_mp4", "mp4_to_mp3", "compress_mp4"],
+    "document": ["pdf_to_docx", "docx_to_pdf", "compress_pdf", "xml_to_json", "json_to_xml",
+                 "xml_to_csv", "json_to_csv", "xls_to_csv", "xls_to_json", "xls_to_xml"],
+    "llm": ["generate_summary", "rewrite_text", "essay_writer", "paragraph_writer",
+            "grammar_checker", "post_writer", "document_code"],
+}
+DEFAULT_COST_CLASS = "image"
+
+_local_semaphores = {}
+_local_semaphores_lock = threading.Lock()
+
+
+class FeatureBusy(Exception):
+    def __init__(self, cost_class, retry_after):
+        super().__init__(f"Too many concurrent {cost_class} requests")
+        self.cost_class = cost_class
+        self.retry_after = retry_after
+
+
+def get_cost_class(feature_key):
+    for cost_class, feature_keys in FEATURE_COST_CLASSES.items():
+        if feature_key in feature_keys:
+            return cost_class
+    return DEFAULT_COST_CLASS
+
+
+def _try_lock_slot(cost_class, limit):
+    # Each slot is a lock file shared by every process on the host; start at a random one to spread load
+    lock_dir = os.path.join(settings.TMP_DIR, "admission")
+    os.makedirs(lock_dir, exist_ok=True)
+    first_slot = random.randrange(limit)
+    for i in range(limit):
+        slot_path = os.path.join(lock_dir, f"{cost_class}.{(first_slot + i) % limit}.lock")
+        slot_file = open(slot_path, "a")
+        try:
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot_file
+        except BlockingIOError:
+            slot_file.close()
+    return None
+
+
+def _get_local_semaphore(cost_class, limit):
+    with _local_semaphores_lock:
+        if cost_class not in _local_semaphores:
+            _local_semaphores[cost_class] = threading.BoundedSemaphore(limit)
+        return _local_semaphores[cost_class]
+
+
+def _try_acquire(cost_class, limit):
+    # Returns a release callable, or None when every slot of the class is taken
+    if fcntl is None:
+        semaphore = _get_local_semaphore(cost_class, limit)
+        return semaphore.release if semaphore.acquire(blocking=False) else None
+    slot_file = _try_lock_slot(cost_class, limit)
+    # Closing the file releases the lock
+    return slot_file.close if slot_file is not None else None
+
+
+def _admission_attempts(feature_key, wait):
+    """Yield ``(release, delay)`` pairs until a slot is free; the caller sleeps ``delay`` between attempts."""
+    cost_class = get_cost_class(feature_key)
+    config = settings.FEATURE_CONCURRENCY_LIMITS[cost_class]
+    if wait is False:
+        wait = config["wait"]
+    started = time.monotonic()
+    deadline = None if wait is None else started + wait
+    delay = 0.05
+    while True:
+        release = _try_acquire(cost_class, config["limit"])
+        if release is not None:
+            metrics.observe_stage("admission_wait", time.monotonic() - started)
+            yield release, 0
+            return
+        if deadline is not None and time.monotonic() >= deadline:
+            raise FeatureBusy(cost_class, config["retry_after"])
+        yield None, delay if deadline is None else min(delay, max(0, deadline - time.monotonic()))
+        delay = min(delay * 2, 0.25)
+
+
+@contextmanager
+def admit(feature_key, wait=False):
+    """Hold one concurrency slot of the feature's cost class while the body runs.
+
+    ``wait=False`` waits for the configured time of the class, ``wait=None`` waits as long as needed.
+    """
+    for release, delay in _admission_attempts(feature_key, wait):
+        if release is None:
+            time.sleep(delay)
+            continue
+        try:
+            yield
+        finally:
+            release()
+        return
+
+
+@asynccontextmanager
+async def admit_async(feature_key, wait=False):
+    """Same as ``admit`` for async views; waiting for a slot does not block the event loop."""
+    for release, delay in _admission_attempts(feature_key, wait):
+        if release is None:
+            await asyncio.sleep(delay)
+            continue
+        try:
+            yield
+        finally:
+            release()
+        return
+
+
+def busy_response(error):
+    response = JsonResponse({"error": str(error)}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    response["Retry-After"] = str(error.retry_after)
+    return response
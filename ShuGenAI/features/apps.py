@@ -10,7 +10,5 @@ class FeaturesConfig(AppConfig):
 
     def ready(self):
         import features.signals
-        directory_path = os.path.join(settings.BASE_DIR, '../tmp')
         # Create the directory if it does not exist
-        if not os.path.exists(directory_path):
-            os.makedirs(directory_path)
+        os.makedirs(settings.TMP_DIR, exist_ok=True)
@@ -0,0 +1,376 @@
+import json
+import math
+import os
+import resource
+import subprocess
+import threading
+import time
+from io import BytesIO
+
+import imageio_ffmpeg
+import numpy as np
+import pandas as pd
+import pillow_heif
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from docx import Document
+from PIL import Image
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+
+from .jobs import build_feature_request
+
+SIZES = ("small", "medium", "large")
+
+# Corpus dimensions per size: image pixels, table rows, document pages, video seconds and text characters
+IMAGE_DIMENSIONS = {"small": (640, 480), "medium": (1920, 1080), "large": (4000, 3000)}
+TABLE_ROWS = {"small": 1000, "medium": 20000, "large": 200000}
+SPREADSHEET_ROWS = {"small": 1000, "medium": 10000, "large": 50000}
+DOCUMENT_PAGES = {"small": 1, "medium": 10, "large": 50}
+VIDEO_CLIPS = {"small": (2, "320x240"), "medium": (5, "640x480"), "large": (10, "1280x720")}
+TEXT_LENGTHS = {"small": 200, "medium": 2000, "large": 20000}
+
+# Features that need the segmentation and inpainting models, only benchmarked on request
+AI_FEATURES = ("remove_background", "edit_background", "pick_up_object", "cut_out_object")
+
+# Parameters sent along with the input of a feature
+FEATURE_PARAMS = {
+    "blur_image": {"blur_intensity": "5"},
+    "compress_image": {"compression_quality": "70"},
+    "edit_background": {"background": "1"},
+}
+
+
+def _image_pixels(size):
+    # A gradient with noise, so that encoders can not shrink the image to nothing
+    width, height = IMAGE_DIMENSIONS[size]
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+    pixels += rng.normal(0, 12, pixels.shape)
+    return np.clip(pixels, 0, 255).astype(np.uint8)
+
+
+def make_image(size, image_format):
+    image = Image.fromarray(_image_pixels(size))
+    buffer = BytesIO()
+    if image_format == "HEIF":
+        pillow_heif.from_pillow(image).save(buffer, quality=90)
+    elif image_format == "PNG":
+        # PNG inputs come with an alpha channel, like the ones png_to_jpg is used for
+        image.putalpha(200)
+        image.save(buffer, format="PNG")
+    elif image_format == "JPEG":
+        image.save(buffer, format="JPEG", quality=90)
+    else:
+        image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def _records(size):
+    return [
+        {"id": i, "name": f"item {i}", "price": round(i * 1.5, 2), "category": f"category {i % 20}"}
+        for i in range(TABLE_ROWS[size])
+    ]
+
+
+def make_xml(size):
+    rows = "".join(
+        f"<record><id>{r['id']}</id><name>{r['name']}</name><price>{r['price']}</price>"
+        f"<category>{r['category']}</category></record>"
+        for r in _records(size)
+    )
+    return f"<records>{rows}</records>".encode("utf-8")
+
+
+def make_json(size):
+    # Nested objects exercise the flattening of json_to_csv
+    records = [{"id": r["id"], "details": {"name": r["name"], "price": r["price"]}} for r in _records(size)]
+    return json.dumps(records).encode("utf-8")
+
+
+def make_xlsx(size):
+    rows = SPREADSHEET_ROWS[size]
+    df = pd.DataFrame({"id": range(rows), "name": [f"item {i}" for i in range(rows)], "unit price": range(rows)})
+    buffer = BytesIO()
+    df.to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def make_pdf(size):
+    buffer = BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=letter)
+    for page in range(DOCUMENT_PAGES[size]):
+        for line in range(40):
+            pdf.drawString(72, 740 - line * 16, f"Page {page + 1}, line {line + 1}: benchmark text for the converters.")
+        pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+
+def make_docx(size):
+    document = Document()
+    for paragraph_number in range(DOCUMENT_PAGES[size] * 20):
+        paragraph = document.add_paragraph(f"Paragraph {paragraph_number + 1} of the benchmark document. ")
+        paragraph.add_run("Bold text. ").bold = True
+        paragraph.add_run("Italic text.").italic = True
+    buffer = BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def make_video(size, extension, work_dir):
+    seconds, dimensions = VIDEO_CLIPS[size]
+    path = os.path.join(work_dir, f"bench_{size}.{extension}")
+    subprocess.run(
+        [imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+         "-f", "lavfi", "-i", f"testsrc=duration={seconds}:size={dimensions}:rate=25",
+         "-f", "lavfi", "-i", f"sine=duration={seconds}",
+         "-shortest", "-c:v", "libx264", "-c:a", "aac", path],
+        check=True,
+    )
+    with open(path, "rb") as video_file:
+        return video_file.read()
+
+
+def make_text(size):
+    sentence = "The quick brown fox jumps over the lazy dog. "
+    return (sentence * (TEXT_LENGTHS[size] // len(sentence) + 1))[:TEXT_LENGTHS[size]]
+
+
+def build_corpus(feature_keys, sizes, work_dir, raw_sample=None):
+    """Return ``{(feature_key, size): (file_name, content)}``; text features get a string instead of a file."""
+    generators = {
+        "jpg": lambda size: make_image(size, "JPEG"),
+        "png": lambda size: make_image(size, "PNG"),
+        "tiff": lambda size: make_image(size, "TIFF"),
+        "heic": lambda size: make_image(size, "HEIF"),
+        "xml": make_xml,
+        "json": make_json,
+        "xlsx": make_xlsx,
+        "pdf": make_pdf,
+        "docx": make_docx,
+        "mp4": lambda size: make_video(size, "mp4", work_dir),
+        "mkv": lambda size: make_video(size, "mkv", work_dir),
+    }
+    generated = {}
+    corpus = {}
+    for feature_key in feature_keys:
+        extension = input_extension(feature_key)
+        for size in sizes:
+            if extension == "txt":
+                corpus[feature_key, size] = (None, make_text(size))
+            elif extension == "raw":
+                # There is no RAW encoder to synthesize camera files with, a real sample has to be provided
+                if raw_sample:
+                    with open(raw_sample, "rb") as raw_file:
+                        corpus[feature_key, size] = (os.path.basename(raw_sample), raw_file.read())
+            else:
+                if (extension, size) not in generated:
+                    generated[extension, size] = generators[extension](size)
+                corpus[feature_key, size] = (f"bench_{size}.{extension}", generated[extension, size])
+    return corpus
+
+
+def input_extension(feature_key):
+    from utilities.text_utils import TEXT_FEATURES
+
+    if feature_key in TEXT_FEATURES:
+        return "txt"
+    extensions = {
+        "heif_to_jpg": "heic", "png_to_jpg": "png", "raw_to_jpg": "raw", "tiff_to_jpg": "tiff",
+        "xml_to_json": "xml", "xml_to_csv": "xml", "json_to_xml": "json", "json_to_csv": "json",
+        "xls_to_csv": "xlsx", "xls_to_json": "xlsx", "xls_to_xml": "xlsx",
+        "pdf_to_docx": "pdf", "compress_pdf": "pdf", "docx_to_pdf": "docx",
+        "mp4_to_gif": "mp4", "mp4_to_mp3": "mp4", "compress_mp4": "mp4", "mkv_to_mp4": "mkv",
+    }
+    return extensions.get(feature_key, "jpg")
+
+
+def make_upload(name, content):
+    # Mirror Django's upload handlers: large files are spooled to disk, small ones stay in memory
+    if len(content) <= settings.FILE_UPLOAD_MAX_MEMORY_SIZE:
+        return SimpleUploadedFile(name, content)
+    uploaded = TemporaryUploadedFile(name, "application/octet-stream", len(content), None)
+    uploaded.write(content)
+    uploaded.seek(0)
+    return uploaded
+
+
+def build_request(user, feature_key, name, content):
+    params = dict(FEATURE_PARAMS.get(feature_key, {}))
+    if name is None:
+        params["text"] = content
+        return build_feature_request(user, params)
+    return build_feature_request(user, params, make_upload(name, content))
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # No procfs, fall back to the peak of the whole process (kilobytes on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakRSSSampler:
+    """Sample the resident set size in the background and keep the highest value seen."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop_event.wait(self.interval)
+
+    def __enter__(self):
+        self.baseline = self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop_event.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile, good enough for the handful of iterations of a benchmark
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def benchmark_feature(run, user, feature_key, size, name, content, iterations, warmup):
+    for _ in range(warmup):
+        try:
+            run(build_request(user, feature_key, name, content), feature_key)
+        except Exception:
+            # The measured runs fail the same way, they report it
+            pass
+    durations, errors, error_message = [], 0, None
+    with PeakRSSSampler() as sampler:
+        for _ in range(iterations):
+            request = build_request(user, feature_key, name, content)
+            start = time.perf_counter()
+            try:
+                response = run(request, feature_key)
+                failed = response.status_code >= 400
+                if failed:
+                    error_message = json.loads(response.content or b"{}").get("error")
+            except Exception as e:
+                failed, error_message = True, str(e)
+            durations.append(time.perf_counter() - start)
+            errors += failed
+    durations.sort()
+    total = sum(durations)
+    return {
+        "feature": feature_key,
+        "size": size,
+        "input_bytes": len(content.encode("utf-8") if name is None else content),
+        "iterations": iterations,
+        "errors": errors,
+        "error": error_message,
+        "throughput_per_second": round(iterations / total, 3) if total else None,
+        "mean_seconds": round(total / iterations, 6) if iterations else None,
+        "p50_seconds": round(percentile(durations, 0.5), 6),
+        "p95_seconds": round(percentile(durations, 0.95), 6),
+        "peak_rss_bytes": sampler.peak,
+        "rss_growth_bytes": sampler.peak - sampler.baseline,
+    }
+
+
+def image_difference(image, reference):
+    """Mean and maximum absolute difference and PSNR of two images of the same size and mode."""
+    difference = np.abs(np.asarray(image, dtype=np.int16) - np.asarray(reference, dtype=np.int16))
+    mse = float(np.mean(difference.astype(np.float64) ** 2))
+    return {
+        "mean_abs_difference": round(float(difference.mean()), 3),
+        "max_abs_difference": int(difference.max()),
+        "psnr_db": round(10 * math.log10(255 ** 2 / mse), 2) if mse else None,
+    }
+
+
+def benchmark_blur(size, radius, iterations):
+    """Time every blur_image mode on one corpus image and compare its output with the exact blur."""
+    from utilities.image_utils import BLUR_MODES, to_blurred
+
+    image = Image.fromarray(_image_pixels(size))
+    results, reference = [], None
+    for blur_mode in BLUR_MODES:
+        params = {"blur_intensity": str(radius), "blur_mode": blur_mode}
+        durations = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            output = to_blurred(image, params)
+            durations.append(time.perf_counter() - start)
+        durations.sort()
+        # BLUR_MODES starts with the exact mode, the output of the feature before the fast one existed
+        if reference is None:
+            reference = output
+        results.append({
+            "mode": blur_mode,
+            "size": size,
+            "radius": radius,
+            "mean_seconds": round(sum(durations) / iterations, 6),
+            "p95_seconds": round(percentile(durations, 0.95), 6),
+            **image_difference(output, reference),
+        })
+    for result in results:
+        # Means round to 0 for the fastest modes on the small images
+        result["speedup"] = (round(results[0]["mean_seconds"] / result["mean_seconds"], 2)
+                             if result["mean_seconds"] else None)
+    return results
+
+
+def transparent_samples(size):
+    """Outputs like the ones of the transparent features: a cut-out photo, a flat sticker and an opaque composite."""
+    width, height = IMAGE_DIMENSIONS[size]
+    photo = Image.fromarray(_image_pixels(size))
+    y, x = np.ogrid[:height, :width]
+    inside = (x - width / 2) ** 2 / (width / 3) ** 2 + (y - height / 2) ** 2 / (height / 3) ** 2 <= 1
+    cut_out = photo.convert("RGBA")
+    cut_out.putalpha(Image.fromarray(inside.astype(np.uint8) * 255))
+    sticker = np.zeros((height, width, 4), np.uint8)
+    sticker[inside] = (230, 60, 40, 255)
+    sticker[inside & (x < width / 2)] = (40, 90, 230, 255)
+    return {
+        "cut_out": cut_out,
+        "sticker": Image.fromarray(sticker, "RGBA"),
+        "composite": photo.convert("RGBA"),
+    }
+
+
+def benchmark_transparent_encoding(size, compression_levels, iterations):
+    """Size and time of every transparent output encoding, against the plain RGBA PNG written before."""
+    from utilities.image_utils import TRANSPARENT_ENCODINGS, encode_image, encode_transparent
+
+    results = []
+    for sample, image in transparent_samples(size).items():
+        baseline_bytes = len(encode_image(image, "baseline.png").read())
+        for encoding in TRANSPARENT_ENCODINGS:
+            for compression_level in compression_levels:
+                options = {"encoding": encoding, "compression_level": compression_level}
+                durations = []
+                for _ in range(iterations):
+                    start = time.perf_counter()
+                    output = encode_transparent(image, "output.png", options)
+                    durations.append(time.perf_counter() - start)
+                durations.sort()
+                results.append({
+                    "sample": sample,
+                    "size": size,
+                    "encoding": encoding,
+                    "compression_level": compression_level,
+                    "bytes": output.size,
+                    "size_ratio": round(output.size / baseline_bytes, 3),
+                    "mean_seconds": round(sum(durations) / iterations, 6),
+                    "p95_seconds": round(percentile(durations, 0.95), 6),
+                })
+    return results
@@ -0,0 +1,72 @@
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Feature
+
+MAX_CACHED_USERS = 10000
+
+# user id -> (allowed feature keys, expiry as a unix timestamp)
+_cache = {}
+_cache_lock = threading.Lock()
+# Bumped by every invalidation, so that a lookup racing with one does not store a stale result
+_generation = 0
+
+
+def load_allowed_feature_keys(user_id):
+    """Resolve the keys of the features in the user's active subscriptions with one query.
+
+    Also returns when the first of those subscriptions ends, as the result is only valid until then.
+    """
+    rows = Feature.objects.filter(
+        plans__subscription__user_id=user_id,
+        plans__subscription__end_date__gt=timezone.now(),
+    ).values_list("key", "plans__subscription__end_date")
+    keys, first_end = set(), None
+    for key, end_date in rows:
+        keys.add(key)
+        first_end = end_date if first_end is None else min(first_end, end_date)
+    return frozenset(keys), first_end
+
+
+def get_allowed_feature_keys(user):
+    now = time.time()
+    with _cache_lock:
+        cached = _cache.get(user.pk)
+        generation = _generation
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    keys, first_end = load_allowed_feature_keys(user.pk)
+    expires_at = now + settings.FEATURE_ENTITLEMENT_CACHE_TTL
+    if first_end is not None:
+        expires_at = min(expires_at, first_end.timestamp())
+    with _cache_lock:
+        if generation == _generation:
+            if len(_cache) >= MAX_CACHED_USERS:
+                _prune(now)
+            _cache[user.pk] = (keys, expires_at)
+    return keys
+
+
+def _prune(now):
+    # Called with the lock held; forget the expired entries, or everything if they are all fresh
+    for user_id in [user_id for user_id, (_, expires_at) in _cache.items() if expires_at <= now]:
+        del _cache[user_id]
+    if len(_cache) >= MAX_CACHED_USERS:
+        _cache.clear()
+
+
+def invalidate(user_id):
+    global _generation
+    with _cache_lock:
+        _generation += 1
+        _cache.pop(user_id, None)
+
+
+def invalidate_all():
+    global _generation
+    with _cache_lock:
+        _generation += 1
+        _cache.clear()
@@ -0,0 +1,211 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from . import rollups
+from .models import History
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Records appended by this process and not inserted yet, with the journal segment they were written to
+_buffer = []
+_segment = None
+_segment_path = None
+_lock = threading.Lock()
+# Serializes flushes, the periodic one and the one at exit may otherwise overlap
+_flush_lock = threading.Lock()
+# Set to flush before the interval is over, once a batch is full
+_flush_event = threading.Event()
+_flusher_pid = None
+
+
+def is_enabled(request):
+    # Jobs need the History row right away to link it, they always insert synchronously
+    return settings.FEATURE_HISTORY_WRITE_BEHIND and getattr(request, "feature_job", None) is None
+
+
+def save_history(request, history):
+    if is_enabled(request):
+        append(history)
+    else:
+        with transaction.atomic():
+            history.save()
+            rollups.record([history])
+            rollups.record_recent_features([history])
+
+
+def append(history):
+    """Journal a History that is not saved yet; the flusher inserts it with the next batch."""
+    history.journal_id = uuid.uuid4()
+    record = json.dumps({
+        "journal_id": str(history.journal_id),
+        "user_id": history.user_id,
+        "feature_id": history.feature_id,
+        "file": history.file.name,
+        "date": history.date.isoformat(),
+    })
+    with _lock:
+        segment = _current_segment()
+        segment.write(record + "\n")
+        segment.flush()
+        # The record has to be on disk before the response tells the client it is stored
+        os.fsync(segment.fileno())
+        _buffer.append(history)
+        batch_full = len(_buffer) >= settings.FEATURE_HISTORY_BATCH_SIZE
+    _ensure_flusher()
+    if batch_full:
+        _flush_event.set()
+
+
+def _journal_dir():
+    path = os.path.join(settings.TMP_DIR, "history_journal")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _current_segment():
+    # Called with the lock held. The segment stays locked while it is open so that
+    # other processes do not mistake it for the leftover of a crashed one.
+    global _segment, _segment_path
+    if _segment is None:
+        path = os.path.join(_journal_dir(), f"{os.getpid()}-{uuid.uuid4().hex}")
+        _segment = open(path + ".open", "a")
+        if fcntl is not None:
+            fcntl.flock(_segment, fcntl.LOCK_EX)
+        # Only visible to replay once it is locked
+        os.rename(path + ".open", path + ".jsonl")
+        _segment_path = path + ".jsonl"
+    return _segment
+
+
+def flush():
+    global _segment, _segment_path
+    with _flush_lock:
+        with _lock:
+            batch, segment, segment_path = _buffer[:], _segment, _segment_path
+            _buffer.clear()
+            _segment = _segment_path = None
+        if segment is None:
+            return
+        try:
+            # The usage rollups are committed with the rows, so a replay of the segment counts nothing twice
+            with transaction.atomic():
+                History.objects.bulk_create(batch, batch_size=settings.FEATURE_HISTORY_BATCH_SIZE,
+                                            ignore_conflicts=True)
+                rollups.record(batch)
+                rollups.record_recent_features(batch)
+        except Exception:
+            # The segment is kept and replayed later, by this process or the next one
+            segment.close()
+            raise
+        os.remove(segment_path)
+        segment.close()
+
+
+def replay():
+    """Insert the records of segments left behind by processes that died before flushing them."""
+    for path in sorted(glob.glob(os.path.join(_journal_dir(), "*.jsonl"))):
+        if path == _segment_path:
+            continue
+        try:
+            segment = open(path)
+        except FileNotFoundError:
+            continue
+        with segment:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Still written by a live process
+                    continue
+            records = []
+            for line in segment:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by the crash was never acknowledged to a client
+                    continue
+                record["journal_id"] = uuid.UUID(record["journal_id"])
+                record["date"] = parse_datetime(record["date"])
+                records.append(History(**record))
+            _insert_missing(records)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            logger.info("Replayed %d history records from %s", len(records), path)
+
+
+def _insert_missing(records):
+    # Records that made it into the database before the crash are skipped, and so are not counted again
+    batch_size = settings.FEATURE_HISTORY_BATCH_SIZE
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        with transaction.atomic():
+            inserted = set(
+                History.objects.filter(journal_id__in=[history.journal_id for history in batch])
+                .values_list("journal_id", flat=True)
+            )
+            batch = [history for history in batch if history.journal_id not in inserted]
+            History.objects.bulk_create(batch)
+            rollups.record(batch)
+            rollups.record_recent_features(batch)
+
+
+def _ensure_flusher():
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_run_flusher, name="history-journal-flusher", daemon=True).start()
+
+
+def _run_flusher():
+    try:
+        replay()
+    except Exception:
+        logger.exception("Failed to replay the history journal")
+    finally:
+        connection.close()
+    while True:
+        # Flush on the interval, or early when a batch is full
+        _flush_event.wait(settings.FEATURE_HISTORY_FLUSH_INTERVAL)
+        _flush_event.clear()
+        close_old_connections()
+        try:
+            flush()
+        except Exception:
+            logger.exception("Failed to flush the history journal")
+            # Give the database some time before retrying from the journal
+            time.sleep(settings.FEATURE_HISTORY_FLUSH_INTERVAL)
+            try:
+                replay()
+            except Exception:
+                logger.exception("Failed to replay the history journal")
+        finally:
+            connection.close()
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception:
+        logger.exception("Failed to flush the history journal at exit, it is replayed on the next start")
@@ -0,0 +1,153 @@
+import json
+import os
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
+from django.http import HttpRequest, QueryDict
+from django.utils import timezone
+from django.utils.datastructures import MultiValueDict
+
+from .models import FeatureJob
+
+# Request fields that only steer how the feature is executed and are not handler parameters
+CONTROL_PARAMS = ("async",)
+
+
+class StoredUpload(UploadedFile):
+    """The job input kept in the storage, exposed like an upload Django already spooled to disk."""
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def wants_async(request):
+    return str(request.POST.get("async", "")).lower() in ("1", "true", "yes")
+
+
+def enqueue_feature_job(request, feature):
+    # Keep only the plain parameters the handler reads from request.POST
+    params = {key: value for key, value in request.POST.items() if key not in CONTROL_PARAMS}
+    job = FeatureJob(
+        user=request.user,
+        feature=feature,
+        params=params,
+        session_key=request.session.session_key,
+    )
+    uploaded = request.FILES.get("file")
+    if uploaded:
+        job.input_name = os.path.basename(uploaded.name)
+        job.input_file.save(job.input_name, uploaded, save=False)
+    job.save()
+    return job
+
+
+def claim_next_job():
+    # Lock the oldest pending job so that concurrent workers never pick the same one
+    with transaction.atomic():
+        job = (
+            FeatureJob.objects.select_for_update(skip_locked=True)
+            .filter(status=FeatureJob.STATUS_PENDING)
+            .order_by("created_at")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = FeatureJob.STATUS_RUNNING
+        job.started_at = job.heartbeat_at = timezone.now()
+        job.attempts += 1
+        job.save(update_fields=["status", "started_at", "heartbeat_at", "attempts"])
+    return job
+
+
+def heartbeat(job_ids):
+    # Tell recover_stale_jobs() that the workers running these jobs are still alive
+    if job_ids:
+        FeatureJob.objects.filter(pk__in=job_ids, status=FeatureJob.STATUS_RUNNING).update(heartbeat_at=timezone.now())
+
+
+def recover_stale_jobs(stale_after=None, max_attempts=None):
+    """Queue again the running jobs whose worker stopped sending heartbeats, e.g. after a crash or a kill.
+
+    Jobs already started ``max_attempts`` times are failed instead, so that an input that brings
+    its worker down is not retried forever. Returns the numbers of jobs requeued and failed.
+    """
+    stale_after = settings.FEATURE_JOB_STALE_AFTER if stale_after is None else stale_after
+    max_attempts = settings.FEATURE_JOB_MAX_ATTEMPTS if max_attempts is None else max_attempts
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    requeued = failed = 0
+    with transaction.atomic():
+        stale_jobs = FeatureJob.objects.select_for_update(skip_locked=True).filter(
+            status=FeatureJob.STATUS_RUNNING, heartbeat_at__lt=cutoff
+        )
+        for job in stale_jobs:
+            if job.attempts >= max_attempts:
+                job.status = FeatureJob.STATUS_FAILED
+                job.error = f"The worker running the job stopped, {job.attempts} times"
+                job.finished_at = timezone.now()
+                if job.input_file:
+                    job.input_file.delete(save=False)
+                failed += 1
+            else:
+                job.status = FeatureJob.STATUS_PENDING
+                job.started_at = job.heartbeat_at = None
+                requeued += 1
+            job.save()
+    return requeued, failed
+
+
+def build_feature_request(user, params, uploaded=None, session_key=None):
+    # Build the request a feature handler would have received in the HTTP cycle
+    request = HttpRequest()
+    request.method = "POST"
+    request.META = {"SERVER_NAME": "localhost", "SERVER_PORT": "80"}
+    request.user = user
+    post = QueryDict(mutable=True)
+    post.update(params)
+    request.POST = post
+    request.FILES = MultiValueDict()
+    if uploaded is not None:
+        request.FILES["file"] = uploaded
+    engine = import_module(settings.SESSION_ENGINE)
+    request.session = engine.SessionStore(session_key=session_key)
+    return request
+
+
+def build_job_request(job):
+    uploaded = None
+    if job.input_file:
+        job.input_file.open("rb")
+        uploaded = StoredUpload(file=job.input_file.file, name=job.input_name, size=job.input_file.size)
+    request = build_feature_request(job.user, job.params, uploaded, job.session_key)
+    request.feature_job = job
+    return request
+
+
+def run_job(job):
+    # Imported here because the views module pulls in every feature handler
+    from .views import determine_feature
+
+    request = build_job_request(job)
+    try:
+        response = determine_feature(request, job.feature.key)
+        payload = json.loads(response.content or b"{}")
+        if response.status_code == 201:
+            job.status = FeatureJob.STATUS_DONE
+            job.history_id = payload.get("id")
+        else:
+            job.status = FeatureJob.STATUS_FAILED
+            job.error = payload.get("error") or payload.get("message") or response.reason_phrase
+        if job.session_key and request.session.modified:
+            request.session.save()
+    except Exception as e:
+        job.status = FeatureJob.STATUS_FAILED
+        job.error = str(e)
+    finally:
+        if job.input_file:
+            job.input_file.close()
+            job.input_file.delete(save=False)
+    job.finished_at = timezone.now()
+    job.save()
+    return job
@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from features.benchmark import SIZES, benchmark_blur
+
+
+class Command(BaseCommand):
+    help = ("Time the blur_image modes on the generated corpus images and report, as JSON, "
+            "their speedup and how far their output is from the exact blur.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="medium,large",
+                            help=f"Comma separated image sizes out of {', '.join(SIZES)}.")
+        parser.add_argument("--radii", default="5,20,50",
+                            help="Comma separated blur radii, in pixels.")
+        parser.add_argument("--iterations", type=int, default=5,
+                            help="Measured runs per mode, size and radius.")
+
+    def handle(self, *args, **options):
+        if options["iterations"] < 1:
+            raise CommandError("Iterations must be at least 1")
+        sizes = [size.strip() for size in options["sizes"].split(",") if size.strip()]
+        if not set(sizes) <= set(SIZES):
+            raise CommandError(f"Sizes must be out of {', '.join(SIZES)}")
+        try:
+            radii = [float(radius) for radius in options["radii"].split(",") if radius.strip()]
+        except ValueError:
+            raise CommandError("Radii must be numbers")
+        results = []
+        for size in sizes:
+            for radius in radii:
+                self.stderr.write(f"Benchmarking radius {radius:g} ({size})...")
+                results.extend(benchmark_blur(size, radius, options["iterations"]))
+        self.stdout.write(json.dumps({"iterations": options["iterations"], "results": results}, indent=2))
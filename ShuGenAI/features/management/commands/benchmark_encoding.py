@@ -0,0 +1,36 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from features.benchmark import SIZES, benchmark_transparent_encoding
+
+
+class Command(BaseCommand):
+    help = ("Encode sample transparent outputs with every output_encoding and compression_level, "
+            "and report as JSON their size next to the plain RGBA PNG and their encoding time.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="medium",
+                            help=f"Comma separated image sizes out of {', '.join(SIZES)}.")
+        parser.add_argument("--levels", default="1,6,9",
+                            help="Comma separated compression levels, from 0 to 9.")
+        parser.add_argument("--iterations", type=int, default=3,
+                            help="Measured runs per sample, encoding and level.")
+
+    def handle(self, *args, **options):
+        if options["iterations"] < 1:
+            raise CommandError("Iterations must be at least 1")
+        sizes = [size.strip() for size in options["sizes"].split(",") if size.strip()]
+        if not set(sizes) <= set(SIZES):
+            raise CommandError(f"Sizes must be out of {', '.join(SIZES)}")
+        try:
+            levels = [int(level) for level in options["levels"].split(",") if level.strip()]
+        except ValueError:
+            raise CommandError("Levels must be integers")
+        if not all(0 <= level <= 9 for level in levels):
+            raise CommandError("Levels must be between 0 and 9")
+        results = []
+        for size in sizes:
+            self.stderr.write(f"Benchmarking the encodings ({size})...")
+            results.extend(benchmark_transparent_encoding(size, levels, options["iterations"]))
+        self.stdout.write(json.dumps({"iterations": options["iterations"], "results": results}, indent=2))
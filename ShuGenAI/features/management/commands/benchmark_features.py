@@ -0,0 +1,89 @@
+import json
+import platform
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import override_settings
+from django.utils import timezone
+
+from features.benchmark import AI_FEATURES, SIZES, benchmark_feature, build_corpus
+from features.views import FEATURES_DICT, determine_feature
+from users.models import User
+from utilities import ai_models
+
+
+class Command(BaseCommand):
+    help = ("Benchmark every feature handler against a generated input corpus and report "
+            "throughput, latency percentiles and peak RSS as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--features", default="",
+                            help="Comma separated feature keys to benchmark, all of them by default.")
+        parser.add_argument("--sizes", default="small,medium",
+                            help=f"Comma separated input sizes out of {', '.join(SIZES)}.")
+        parser.add_argument("--iterations", type=int, default=5,
+                            help="Measured runs per feature and size.")
+        parser.add_argument("--warmup", type=int, default=1,
+                            help="Unmeasured runs before the measured ones.")
+        parser.add_argument("--include-ai", action="store_true",
+                            help="Also benchmark the features that need the segmentation and inpainting models.")
+        parser.add_argument("--raw-sample",
+                            help="Camera RAW file used for raw_to_jpg, which is skipped without it.")
+        parser.add_argument("--label", default="",
+                            help="Free form label stored in the report, e.g. the release being measured.")
+        parser.add_argument("--output",
+                            help="Write the JSON report to this file instead of stdout, where moviepy also logs.")
+
+    def handle(self, *args, **options):
+        if options["iterations"] < 1:
+            raise CommandError("Iterations must be at least 1")
+        if options["warmup"] < 0:
+            raise CommandError("Warmup must not be negative")
+        feature_keys = [key.strip() for key in options["features"].split(",") if key.strip()] or list(FEATURES_DICT)
+        unknown_keys = [key for key in feature_keys if key not in FEATURES_DICT]
+        if unknown_keys:
+            raise CommandError(f"Unknown features: {', '.join(unknown_keys)}")
+        if not options["include_ai"]:
+            feature_keys = [key for key in feature_keys if key not in AI_FEATURES]
+        elif any(key in AI_FEATURES for key in feature_keys):
+            self.load_ai_models()
+        sizes = [size.strip() for size in options["sizes"].split(",") if size.strip()]
+        if not set(sizes) <= set(SIZES):
+            raise CommandError(f"Sizes must be out of {', '.join(SIZES)}")
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            self.stderr.write("Generating the input corpus...")
+            corpus = build_corpus(feature_keys, sizes, work_dir, options["raw_sample"])
+            # Outputs go to a throw-away media root and every row written is rolled back at the end
+            # Unbuffered usage counts, so that they are rolled back with the rest instead of flushed later
+            with override_settings(MEDIA_ROOT=work_dir, USE_MOCK_OUTPUT=True, FEATURE_CACHE_ENABLED=False,
+                                   FEATURE_USAGE_FLUSH_INTERVAL=0), transaction.atomic():
+                user = User.objects.create(email="benchmark@localhost")
+                results = []
+                for (feature_key, size), (name, content) in corpus.items():
+                    self.stderr.write(f"Benchmarking {feature_key} ({size})...")
+                    results.append(benchmark_feature(determine_feature, user, feature_key, size, name, content,
+                                                     options["iterations"], options["warmup"]))
+                transaction.set_rollback(True)
+
+        report = {
+            "label": options["label"],
+            "created_at": timezone.now().isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "iterations": options["iterations"],
+            "skipped": sorted(set(feature_keys) - {key for key, _ in corpus}),
+            "results": results,
+            "models": ai_models.models.report(),
+        }
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                output_file.write(output)
+        else:
+            self.stdout.write(output)
+
+    def load_ai_models(self):
+        # Loaded before the measured runs, a lazy load would be billed to the first feature using it
+        ai_models.models.warm_up(ai_models.MODEL_LOADERS)
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from features import result_cache, retention
+
+
+class Command(BaseCommand):
+    help = ("Delete the History rows past their feature's retention together with their files, "
+            "evict from the result cache, then sweep orphan media files, old segmented previews "
+            "and TMP_DIR leftovers. Meant to be run periodically, e.g. daily from cron.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Rows deleted per transaction and files checked per query.")
+        parser.add_argument("--pause", type=float, default=0.1,
+                            help="Seconds to sleep between two batches, to leave room for the live traffic.")
+        parser.add_argument("--grace-period", type=int, default=settings.FEATURE_MEDIA_GC_GRACE_PERIOD,
+                            help="Files younger than this many seconds are never swept.")
+        parser.add_argument("--skip-sweep", action="store_true",
+                            help="Only delete the expired history, do not look for orphan files.")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Report what would be deleted without deleting anything.")
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        verb = "Would delete" if dry_run else "Deleted"
+        rows, files = retention.purge_expired_history(
+            batch_size=options["batch_size"], pause=options["pause"], dry_run=dry_run,
+            log=self.stdout.write if options["verbosity"] > 1 else None,
+        )
+        self.stdout.write(f"{verb} {rows} expired history rows and {files} of their files")
+        if not dry_run:
+            # Before the sweep, which then deletes the outputs no other row points at
+            evicted = result_cache.evict(resync=True)
+            self.stdout.write(f"Evicted {evicted} cached results")
+        if options["skip_sweep"]:
+            return
+        orphans = retention.sweep_orphan_files(options["grace_period"], options["batch_size"], dry_run)
+        self.stdout.write(f"{verb} {orphans} orphan media files")
+        previews = retention.sweep_segmented_images(settings.FEATURE_SEGMENTED_IMAGE_MAX_AGE, dry_run)
+        self.stdout.write(f"{verb} {previews} segmented previews")
+        leftovers = retention.sweep_tmp_dir(options["grace_period"], dry_run)
+        self.stdout.write(f"{verb} {leftovers} temporary files")
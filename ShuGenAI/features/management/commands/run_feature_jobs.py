@@ -0,0 +1,98 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from features.jobs import claim_next_job, heartbeat, recover_stale_jobs, run_job
+
+
+class Command(BaseCommand):
+    help = "Run queued asynchronous feature jobs with a pool of worker threads."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=settings.FEATURE_JOB_WORKERS,
+                            help="Number of jobs processed in parallel.")
+        parser.add_argument("--poll-interval", type=float, default=settings.FEATURE_JOB_POLL_INTERVAL,
+                            help="Seconds to wait before polling again when the queue is empty.")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit as soon as the queue is empty instead of polling forever.")
+
+    def handle(self, *args, **options):
+        self.stop_event = threading.Event()
+        # Ids of the jobs this process is running, their heartbeats are sent by a thread of their own
+        self.running_jobs = set()
+        self.running_jobs_lock = threading.Lock()
+        self.recover()
+        threading.Thread(target=self.send_heartbeats, args=(settings.FEATURE_JOB_HEARTBEAT_INTERVAL,),
+                         daemon=True).start()
+        threads = [
+            threading.Thread(target=self.work, args=(options["poll_interval"], options["once"]), daemon=True)
+            for _ in range(max(1, options["workers"]))
+        ]
+        self.stdout.write(f"Starting {len(threads)} feature job worker(s)")
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            # Let the running jobs finish, but do not pick up new ones
+            self.stop_event.set()
+            for thread in threads:
+                thread.join()
+
+    def work(self, poll_interval, once):
+        try:
+            while not self.stop_event.is_set():
+                close_old_connections()
+                try:
+                    job = claim_next_job()
+                except Exception as e:
+                    # A lost database connection should not kill the worker thread
+                    self.stderr.write(f"Failed to claim a job: {e}")
+                    time.sleep(poll_interval)
+                    continue
+                if job is None:
+                    if once:
+                        return
+                    time.sleep(poll_interval)
+                    continue
+                with self.running_jobs_lock:
+                    self.running_jobs.add(job.pk)
+                try:
+                    job = run_job(job)
+                finally:
+                    with self.running_jobs_lock:
+                        self.running_jobs.discard(job.pk)
+                self.stdout.write(f"Job #{job.pk} ({job.feature.key}) finished with status {job.status}")
+        finally:
+            connection.close()
+
+    def recover(self):
+        try:
+            requeued, failed = recover_stale_jobs()
+        except Exception as e:
+            self.stderr.write(f"Failed to recover the stale jobs: {e}")
+            return
+        if requeued or failed:
+            self.stdout.write(f"Recovered the jobs of stopped workers: {requeued} queued again, {failed} failed")
+
+    def send_heartbeats(self, interval):
+        # Also the one place that looks for the jobs of workers that stopped, in this process or another one.
+        # Runs until the process exits, the jobs still running after a stop request need their heartbeats
+        try:
+            while True:
+                time.sleep(interval)
+                close_old_connections()
+                with self.running_jobs_lock:
+                    job_ids = list(self.running_jobs)
+                try:
+                    heartbeat(job_ids)
+                except Exception as e:
+                    self.stderr.write(f"Failed to send the job heartbeats: {e}")
+                self.recover()
+        finally:
+            connection.close()
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:13
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("features", "0005_cachedresult"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="subscription",
+            index=models.Index(
+                fields=["user", "end_date"], name="features_su_user_id_bddd5b_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:15
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("features", "0006_subscription_user_end_date_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="history",
+            name="journal_id",
+            field=models.UUIDField(blank=True, editable=False, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name="history",
+            name="date",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
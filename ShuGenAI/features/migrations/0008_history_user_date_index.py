@@ -0,0 +1,21 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:16
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("features", "0007_history_journal_id"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="history",
+            index=models.Index(
+                fields=["user", "-date"], name="features_hi_user_id_0e4f54_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,97 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+# Frozen copy of features.signals.FEATURE_CATEGORIES as of this migration, do not update it: migrations
+# must not depend on application code that keeps changing. New features are categorized by the signal.
+FEATURE_CATEGORIES = {
+    "text": [
+        "generate_summary", "rewrite_text", "essay_writer", "paragraph_writer", "grammar_checker", "post_writer",
+        "document_code",
+    ],
+    "image": [
+        "black_and_white", "round_image", "pixelate_image", "blur_image", "compress_image", "remove_background",
+        "edit_background", "pick_up_object", "cut_out_object",
+    ],
+    "file": [
+        "pdf_to_docx", "heif_to_jpg", "png_to_jpg", "raw_to_jpg", "tiff_to_jpg", "xml_to_json", "json_to_xml",
+        "xml_to_csv", "json_to_csv", "xls_to_csv", "xls_to_json", "xls_to_xml", "docx_to_pdf", "compress_pdf",
+        "mp4_to_gif", "mkv_to_mp4", "mp4_to_mp3", "compress_mp4",
+    ],
+}
+
+
+def categorize_features(apps, schema_editor):
+    Feature = apps.get_model("features", "Feature")
+    for category, keys in FEATURE_CATEGORIES.items():
+        Feature.objects.filter(key__in=keys).update(category=category)
+
+
+def build_usage_rollups(apps, schema_editor):
+    # One pass over the existing history, the rollups are maintained as rows are inserted from now on
+    History = apps.get_model("features", "History")
+    FeatureUsageRollup = apps.get_model("features", "FeatureUsageRollup")
+    rows = (
+        History.objects.annotate(day=TruncDate("date"))
+        .values("day", "feature_id")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    FeatureUsageRollup.objects.bulk_create(
+        (FeatureUsageRollup(day=row["day"], feature_id=row["feature_id"], count=row["count"]) for row in rows),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("features", "0008_history_user_date_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="feature",
+            name="category",
+            field=models.CharField(
+                blank=True,
+                choices=[("text", "Text"), ("image", "Image"), ("file", "File")],
+                max_length=16,
+            ),
+        ),
+        migrations.CreateModel(
+            name="FeatureUsageRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "feature",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="features.feature",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("day", "feature"), name="unique_feature_usage_rollup"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(categorize_features, migrations.RunPython.noop),
+        migrations.RunPython(build_usage_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("features", "0009_feature_category_usage_rollup"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="feature",
+            name="retention_days",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:23
+
+import django.core.files.storage
+import features.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("features", "0010_feature_retention_days"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="cachedresult",
+            name="file",
+            field=models.FileField(
+                max_length=255,
+                storage=django.core.files.storage.FileSystemStorage(
+                    allow_overwrite=True
+                ),
+                upload_to=features.storage.history_upload_to,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="history",
+            name="file",
+            field=models.FileField(
+                blank=True,
+                max_length=255,
+                null=True,
+                storage=django.core.files.storage.FileSystemStorage(
+                    allow_overwrite=True
+                ),
+                upload_to=features.storage.history_upload_to,
+            ),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:50
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def build_recent_features(apps, schema_editor):
+    # One pass over the existing history, the table is maintained as rows are inserted from now on
+    History = apps.get_model("features", "History")
+    RecentFeature = apps.get_model("features", "RecentFeature")
+    rows = (
+        History.objects.filter(user__isnull=False)
+        .values("user_id", "feature_id")
+        .annotate(last_used=Max("date"))
+        .order_by()
+    )
+    RecentFeature.objects.bulk_create(
+        (RecentFeature(user_id=row["user_id"], feature_id=row["feature_id"], last_used=row["last_used"])
+         for row in rows),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("features", "0011_sharded_output_paths"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RecentFeature",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("last_used", models.DateTimeField()),
+                (
+                    "feature",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="features.feature",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user", "-last_used"],
+                        name="features_re_user_id_3d06b5_idx",
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("user", "feature"), name="unique_recent_feature"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(build_recent_features, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:52
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def start_heartbeats(apps, schema_editor):
+    # Jobs running during the upgrade count from their start, so that recover_stale_jobs() sees them too
+    FeatureJob = apps.get_model("features", "FeatureJob")
+    FeatureJob.objects.filter(status="running").update(heartbeat_at=F("started_at"), attempts=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("features", "0012_recent_features"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="featurejob",
+            name="attempts",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="featurejob",
+            name="heartbeat_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(start_heartbeats, migrations.RunPython.noop),
+    ]
@@ -1,13 +1,29 @@
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.utils import timezone
+
+from .storage import history_upload_to, output_storage
 
 User = get_user_model()
 
 
 # Create your models here.
 class Feature (models.Model):
+    CATEGORY_TEXT = "text"
+    CATEGORY_IMAGE = "image"
+    CATEGORY_FILE = "file"
+    CATEGORY_CHOICES = (
+        (CATEGORY_TEXT, "Text"),
+        (CATEGORY_IMAGE, "Image"),
+        (CATEGORY_FILE, "File"),
+    )
+
     key = models.CharField(max_length=64, unique=True)
     used_count = models.IntegerField(default=0)
+    category = models.CharField(max_length=16, choices=CATEGORY_CHOICES, blank=True)
+    # Days the history of this feature is kept (see `manage.py purge_history`), 0 forever,
+    # empty for settings.FEATURE_HISTORY_RETENTION_DAYS
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self):
         return self.key
@@ -27,17 +43,104 @@ class Subscription(models.Model):
     start_date = models.DateTimeField(auto_now_add=True)
     end_date = models.DateTimeField()
 
+    class Meta:
+        # Active subscriptions of a user are looked up on every feature call
+        indexes = [models.Index(fields=["user", "end_date"])]
+
     def __str__(self):
         return f"{self.user.email} - {self.plan.key} ({self.start_date} to {self.end_date})"
 
 
 class History(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
-    date = models.DateTimeField(auto_now_add=True)
-    file = models.FileField(upload_to="history", null=True, blank=True)
+    # Not auto_now_add, rows inserted later by the history journal keep the time of the call
+    date = models.DateTimeField(default=timezone.now)
+    file = models.FileField(upload_to=history_upload_to, storage=output_storage, max_length=255,
+                            null=True, blank=True)
     feature = models.ForeignKey(Feature, on_delete=models.CASCADE)
+    # Set for rows written through the history journal, makes its replay idempotent
+    journal_id = models.UUIDField(null=True, blank=True, unique=True, editable=False)
+
+    class Meta:
+        # Serves the paginated history of a user, newest first
+        indexes = [models.Index(fields=["user", "-date"])]
 
     def __str__(self):
         return f"{self.date} - {self.feature.key}"
 
 
+class FeatureUsageRollup(models.Model):
+    # Calls of a feature per day, kept up to date as History rows are inserted
+    day = models.DateField()
+    feature = models.ForeignKey(Feature, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["day", "feature"], name="unique_feature_usage_rollup")]
+
+    def __str__(self):
+        return f"{self.day} - {self.feature.key}: {self.count}"
+
+
+class RecentFeature(models.Model):
+    # Last use of each feature by a user, kept up to date as History rows are inserted
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    feature = models.ForeignKey(Feature, on_delete=models.CASCADE)
+    last_used = models.DateTimeField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["user", "feature"], name="unique_recent_feature")]
+        # Serves the recent features of a user, newest first
+        indexes = [models.Index(fields=["user", "-last_used"])]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.feature.key}: {self.last_used}"
+
+
+class FeatureJob(models.Model):
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "Pending"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    feature = models.ForeignKey(Feature, on_delete=models.CASCADE)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    params = models.JSONField(default=dict, blank=True)
+    input_file = models.FileField(upload_to="jobs", null=True, blank=True)
+    input_name = models.CharField(max_length=255, blank=True)
+    session_key = models.CharField(max_length=40, null=True, blank=True)
+    history = models.ForeignKey(History, on_delete=models.SET_NULL, null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Refreshed by the worker while the job runs, see jobs.recover_stale_jobs()
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+    def __str__(self):
+        return f"{self.feature.key} job #{self.pk} ({self.status})"
+
+
+class CachedResult(models.Model):
+    # sha256 over the feature key, the uploaded bytes and the request parameters
+    key = models.CharField(max_length=64, unique=True)
+    feature = models.ForeignKey(Feature, on_delete=models.CASCADE)
+    file = models.FileField(upload_to=history_upload_to, storage=output_storage, max_length=255)
+    size = models.BigIntegerField(default=0)
+    hits = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.feature.key} - {self.key[:12]}"
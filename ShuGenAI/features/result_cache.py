@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import F, Sum
+from django.http import JsonResponse
+from django.utils import timezone
+from rest_framework import status
+
+from . import history_journal, usage
+from .jobs import CONTROL_PARAMS
+from .models import CachedResult, History
+from .serializers import HistorySerializer
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# Bytes of the cached outputs: the last sum over the table, plus what this process stored and deleted since
+_size_total = None
+_summed_at = 0.0
+# Whether this process stored results since its last eviction, the evictor thread has nothing to do otherwise
+_stored_since_evict = False
+# Process that started the evictor thread; a forked child has to start its own
+_evictor_pid = None
+
+
+def build_cache_key(request, feature_key):
+    # Only file based features with deterministic output are cached
+    if not settings.FEATURE_CACHE_ENABLED or feature_key in settings.FEATURE_CACHE_EXCLUDED_KEYS:
+        return None
+    if request.FILES.get("file") is None:
+        return None
+    # Every upload is part of the input, e.g. the custom background of edit_background next to the photo
+    content_hash = hashlib.sha256()
+    for field_name, uploads in sorted(request.FILES.lists()):
+        for uploaded in uploads:
+            content_hash.update(f"\0{field_name}\0{uploaded.size}\0".encode("utf-8"))
+            for chunk in uploaded.chunks():
+                content_hash.update(chunk)
+            uploaded.seek(0)
+    params = sorted((key, value) for key, value in request.POST.items() if key not in CONTROL_PARAMS)
+    key_source = f"{feature_key}\0{content_hash.hexdigest()}\0{json.dumps(params)}"
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+def serve_cached(request, cache_key):
+    oldest_allowed = timezone.now() - timedelta(seconds=settings.FEATURE_CACHE_MAX_AGE)
+    entry = (
+        CachedResult.objects.select_related("feature")
+        .filter(key=cache_key, last_used_at__gte=oldest_allowed)
+        .first()
+    )
+    if entry is None:
+        return None
+    if not entry.file.storage.exists(entry.file.name):
+        # The output was removed from storage behind our back
+        entry.delete()
+        return None
+    CachedResult.objects.filter(pk=entry.pk).update(hits=F("hits") + 1, last_used_at=timezone.now())
+    # Record the call in the user's history, pointing at the already stored output
+    user = request.user if request.user.is_authenticated else None
+    feature = entry.feature
+    history = History(user=user, file=entry.file.name, feature=feature)
+    history_journal.save_history(request, history)
+    usage.record_use(feature.key)
+    # The serialized feature shows the uses still buffered, this one included
+    history.feature, = usage.with_pending_counts([feature])
+    serializer = HistorySerializer(history, context={'request': request})
+    response = JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
+    response["X-Feature-Cache"] = "HIT"
+    response.history = history
+    return response
+
+
+def store(cache_key, response):
+    """Remember the output of a response; the cache is brought back within its limits by evict()."""
+    global _stored_since_evict, _size_total
+    # The History may not be inserted yet in write-behind mode, use the instance the response was built from
+    history = getattr(response, "history", None)
+    if history is None or not history.file:
+        return
+    size = history.file.size
+    CachedResult.objects.update_or_create(
+        key=cache_key,
+        defaults={
+            "feature_id": history.feature_id,
+            "file": history.file.name,
+            "size": size,
+            "last_used_at": timezone.now(),
+        },
+    )
+    with _lock:
+        _stored_since_evict = True
+        if _size_total is not None:
+            _size_total += size
+    if settings.FEATURE_CACHE_EVICT_INTERVAL <= 0:
+        # Unbuffered mode, evict in the request
+        evict()
+    else:
+        _ensure_evictor()
+
+
+def evict(resync=False):
+    """Delete the entries past FEATURE_CACHE_MAX_AGE, then the least recently used ones until the cache fits.
+
+    The size of the cache is summed once per FEATURE_CACHE_SIZE_RESYNC_INTERVAL, or when ``resync``;
+    in between it is kept up to date with what this process stored and deleted. The outputs of the
+    deleted entries are left to sweep_orphan_files(), other rows may still point at them.
+    Returns the number of entries deleted.
+    """
+    global _size_total, _summed_at
+    oldest_allowed = timezone.now() - timedelta(seconds=settings.FEATURE_CACHE_MAX_AGE)
+    expired_count, expired_size = _delete(
+        CachedResult.objects.filter(last_used_at__lt=oldest_allowed).values_list("id", "size")
+    )
+    now = time.monotonic()
+    with _lock:
+        resync = resync or _size_total is None or now - _summed_at >= settings.FEATURE_CACHE_SIZE_RESYNC_INTERVAL
+        if not resync:
+            _size_total -= expired_size
+    if resync:
+        summed = CachedResult.objects.aggregate(total=Sum("size"))["total"] or 0
+        with _lock:
+            _size_total, _summed_at = summed, now
+    total_size = _size_total
+    if total_size <= settings.FEATURE_CACHE_MAX_BYTES:
+        return expired_count
+    evicted = []
+    for entry_id, size in CachedResult.objects.order_by("last_used_at").values_list("id", "size").iterator():
+        if total_size <= settings.FEATURE_CACHE_MAX_BYTES:
+            break
+        evicted.append((entry_id, size))
+        total_size -= size
+    evicted_count, evicted_size = _delete(evicted)
+    with _lock:
+        _size_total -= evicted_size
+    return expired_count + evicted_count
+
+
+def _delete(entries):
+    # Returns the number and the total size of the entries deleted
+    entries = list(entries)
+    if entries:
+        CachedResult.objects.filter(pk__in=[entry_id for entry_id, _ in entries]).delete()
+    return len(entries), sum(size for _, size in entries)
+
+
+def _ensure_evictor():
+    global _evictor_pid
+    if _evictor_pid == os.getpid():
+        return
+    with _lock:
+        if _evictor_pid == os.getpid():
+            return
+        _evictor_pid = os.getpid()
+    threading.Thread(target=_run_evictor, name="feature-cache-evictor", daemon=True).start()
+
+
+def _run_evictor():
+    global _stored_since_evict
+    while True:
+        time.sleep(settings.FEATURE_CACHE_EVICT_INTERVAL)
+        with _lock:
+            stored, _stored_since_evict = _stored_since_evict, False
+        if not stored:
+            continue
+        close_old_connections()
+        try:
+            evict()
+        except Exception:
+            logger.exception("Failed to evict from the feature result cache")
+            with _lock:
+                _stored_since_evict = True
+        finally:
+            connection.close()
@@ -0,0 +1,152 @@
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .models import CachedResult, Feature, FeatureJob, History, RecentFeature
+
+# Storage directories whose files are referenced from the database, see referenced_files()
+REFERENCED_DIRS = ("history", "jobs")
+# Previews of the object pickers, only needed while the user picks the objects
+SEGMENTED_IMAGES_DIR = "segmented_images"
+
+
+def retention_days(feature):
+    # The feature's own policy first, then the site wide default; 0 keeps the history forever
+    if feature.retention_days is not None:
+        return feature.retention_days
+    return settings.FEATURE_HISTORY_RETENTION_DAYS
+
+
+def referenced_files(names, excluded_history_ids=()):
+    """Return the subset of the storage names still used by a History, a cached result or a queued job."""
+    names = list(names)
+    referenced = set()
+    for model, field in ((History, "file"), (CachedResult, "file"), (FeatureJob, "input_file")):
+        queryset = model.objects.filter(**{f"{field}__in": names})
+        if model is History:
+            queryset = queryset.exclude(id__in=excluded_history_ids)
+        referenced.update(queryset.values_list(field, flat=True))
+    return referenced
+
+
+def delete_files(names, dry_run=False, excluded_history_ids=()):
+    # Only the files nothing points at anymore, several rows can share one output through the result cache
+    unreferenced = set(names) - referenced_files(names, excluded_history_ids)
+    if not dry_run:
+        for name in unreferenced:
+            default_storage.delete(name)
+    return len(unreferenced)
+
+
+def purge_expired_history(batch_size=1000, pause=0, dry_run=False, log=None):
+    """Delete the History rows past their feature's retention, one short transaction per batch.
+
+    Returns the number of rows and files deleted.
+    """
+    rows_deleted = files_deleted = 0
+    for feature in Feature.objects.all():
+        days = retention_days(feature)
+        if not days:
+            continue
+        cutoff = timezone.now() - timedelta(days=days)
+        if not dry_run:
+            # A feature whose history of a user is all gone is no longer one of their recent features
+            RecentFeature.objects.filter(feature=feature, last_used__lt=cutoff).delete()
+        expired = History.objects.filter(feature=feature, date__lt=cutoff).order_by("id")
+        last_id = 0
+        while True:
+            # Walk the ids rather than deleting by date, so that no statement locks more than one batch
+            batch = list(expired.filter(id__gt=last_id).values_list("id", "file")[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            ids = [history_id for history_id, _ in batch]
+            if not dry_run:
+                History.objects.filter(id__in=ids).delete()
+            rows_deleted += len(ids)
+            # A dry run leaves the rows in place, they must not count as references to their own files
+            files_deleted += delete_files({name for _, name in batch if name}, dry_run,
+                                          excluded_history_ids=ids if dry_run else ())
+            if log:
+                log(f"{feature.key}: deleted {len(ids)} history rows older than {days} days")
+            if pause:
+                time.sleep(pause)
+    return rows_deleted, files_deleted
+
+
+def walk_storage(directory):
+    """Yield the storage names of the files under a directory, subdirectories included."""
+    try:
+        subdirectories, files = default_storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in files:
+        yield f"{directory}/{name}"
+    for subdirectory in subdirectories:
+        yield from walk_storage(f"{directory}/{subdirectory}")
+
+
+def _older_than(name, cutoff):
+    try:
+        return default_storage.get_modified_time(name) < cutoff
+    except FileNotFoundError:
+        return False
+
+
+def sweep_orphan_files(grace_period, batch_size=1000, dry_run=False):
+    """Delete stored files no row references, e.g. the outputs of deleted users or of evicted cache entries.
+
+    Files younger than the grace period are kept: their row may not be inserted yet, for instance
+    in write-behind mode or while the request that wrote them is still running.
+    """
+    cutoff = timezone.now() - timedelta(seconds=grace_period)
+    deleted = 0
+    for directory in REFERENCED_DIRS:
+        batch = []
+        for name in walk_storage(directory):
+            if _older_than(name, cutoff):
+                batch.append(name)
+            if len(batch) >= batch_size:
+                deleted += delete_files(batch, dry_run)
+                batch = []
+        deleted += delete_files(batch, dry_run)
+    return deleted
+
+
+def sweep_segmented_images(max_age, dry_run=False):
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    deleted = 0
+    for name in walk_storage(SEGMENTED_IMAGES_DIR):
+        if _older_than(name, cutoff):
+            if not dry_run:
+                default_storage.delete(name)
+            deleted += 1
+    return deleted
+
+
+def sweep_tmp_dir(grace_period, dry_run=False):
+    """Delete the leftovers of failed conversions and uploads from TMP_DIR.
+
+    Only the files directly in it are swept, plus the journal segments a crashed process left
+    before it could lock them; the lock files and the journal segments waiting for replay are kept.
+    """
+    cutoff = time.time() - grace_period
+    candidates = [entry for entry in os.scandir(settings.TMP_DIR) if entry.is_file()]
+    journal_dir = os.path.join(settings.TMP_DIR, "history_journal")
+    if os.path.isdir(journal_dir):
+        candidates += [entry for entry in os.scandir(journal_dir) if entry.name.endswith(".open")]
+    deleted = 0
+    for entry in candidates:
+        try:
+            if entry.stat().st_mtime >= cutoff:
+                continue
+            if not dry_run:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            continue
+        deleted += 1
+    return deleted
@@ -0,0 +1,110 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from users.models import UserSignupRollup
+
+from . import usage
+from .models import Feature, FeatureUsageRollup, RecentFeature
+
+
+def record(histories):
+    """Count History rows that were just inserted; buffered and written with the feature usage counts."""
+    usage.record_rollups(Counter((timezone.localdate(history.date), history.feature_id) for history in histories))
+
+
+def write(counts):
+    # All or nothing, a failed flush keeps the whole batch for the next one
+    with transaction.atomic():
+        for (day, feature_id), count in counts.items():
+            _increment(FeatureUsageRollup, count, day=day, feature_id=feature_id)
+
+
+def record_recent_features(histories):
+    """Move the last use of the users' features forward, in the caller's transaction."""
+    last_uses = {}
+    for history in histories:
+        if history.user_id is not None:
+            key = (history.user_id, history.feature_id)
+            last_uses[key] = max(last_uses.get(key, history.date), history.date)
+    for (user_id, feature_id), last_used in last_uses.items():
+        lookup = {"user_id": user_id, "feature_id": feature_id}
+        # Greatest, so that replaying an older journal segment never moves it back
+        if RecentFeature.objects.filter(**lookup).update(last_used=Greatest("last_used", Value(last_used))):
+            continue
+        try:
+            with transaction.atomic():
+                RecentFeature.objects.create(last_used=last_used, **lookup)
+        except IntegrityError:
+            # Created by a concurrent call since the update
+            RecentFeature.objects.filter(**lookup).update(last_used=Greatest("last_used", Value(last_used)))
+
+
+def record_signup(count=1):
+    # Negative for deleted accounts
+    _increment(UserSignupRollup, count, day=timezone.localdate())
+
+
+def _increment(model, count, **lookup):
+    if model.objects.filter(**lookup).update(count=F("count") + count):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(count=count, **lookup)
+    except IntegrityError:
+        # Created by a concurrent call since the update
+        model.objects.filter(**lookup).update(count=F("count") + count)
+
+
+def _in_range(queryset, date_from, date_to):
+    if date_from:
+        queryset = queryset.filter(day__gte=date_from)
+    if date_to:
+        queryset = queryset.filter(day__lte=date_to)
+    return queryset
+
+
+def usage_by_category(date_from=None, date_to=None):
+    """Return ``{category: calls}`` for the days in the range, both ends included."""
+    rows = (
+        _in_range(FeatureUsageRollup.objects.all(), date_from, date_to)
+        .values_list("feature__category")
+        .annotate(total=Sum("count"))
+        .order_by()
+    )
+    counts = {category: 0 for category, _ in Feature.CATEGORY_CHOICES}
+    for category, total in rows:
+        if category:
+            counts[category] = total
+    return counts
+
+
+def user_count():
+    return UserSignupRollup.objects.aggregate(total=Sum("count"))["total"] or 0
+
+
+def daily_usage(date_from, date_to):
+    """Calls per category and new accounts for every day of the range, days without any included."""
+    days = {}
+    day = date_from
+    while day <= date_to:
+        days[day] = {"day": day, **{category: 0 for category, _ in Feature.CATEGORY_CHOICES},
+                     "total": 0, "new_users": 0}
+        day += timedelta(days=1)
+    usage_rows = (
+        _in_range(FeatureUsageRollup.objects.all(), date_from, date_to)
+        .values_list("day", "feature__category")
+        .annotate(total=Sum("count"))
+        .order_by()
+    )
+    for day, category, total in usage_rows:
+        if category:
+            days[day][category] += total
+        days[day]["total"] += total
+    for day, count in _in_range(UserSignupRollup.objects.all(), date_from, date_to).values_list("day", "count"):
+        days[day]["new_users"] = count
+    return list(days.values())
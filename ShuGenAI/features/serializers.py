@@ -1,12 +1,13 @@
 from rest_framework import serializers
-from .models import Feature, History, Plans, Subscription
+from .models import Feature, History, Plans, Subscription, FeatureJob
 from django.conf import settings
+from django.urls import reverse
 
 
 class FeatureSerializer(serializers.ModelSerializer):
     class Meta:
         model = Feature
-        fields = ['id', 'key', 'used_count']
+        fields = ['id', 'key', 'used_count', 'category']
 
 
 class HistorySerializer(serializers.ModelSerializer):
@@ -24,6 +25,19 @@ class HistorySerializer(serializers.ModelSerializer):
         return f"{settings.MEDIA_URL}{obj.file}"  # Builds full URL if no request
 
 
+class HistoryLightSerializer(serializers.ModelSerializer):
+    # Cheap variant for long history lists: feature key only and the file URL relative to the site
+    feature = serializers.SlugRelatedField(slug_field='key', read_only=True)
+    file = serializers.SerializerMethodField()
+
+    class Meta:
+        model = History
+        fields = ['id', 'date', 'feature', 'file']
+
+    def get_file(self, obj):
+        return obj.file.url if obj.file else None
+
+
 class PlansSerializer(serializers.ModelSerializer):
     features = FeatureSerializer(many=True, read_only=True)
 
@@ -41,3 +55,21 @@ class FeatureKeySerializer(serializers.ModelSerializer):
     class Meta:
         model = Feature
         fields = ['key']  # Only serialize the feature key
+
+
+class FeatureJobSerializer(serializers.ModelSerializer):
+    feature = serializers.SlugRelatedField(slug_field='key', read_only=True)
+    result = HistorySerializer(source='history', read_only=True)
+    status_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = FeatureJob
+        fields = ['id', 'feature', 'status', 'status_url', 'created_at', 'started_at', 'finished_at',
+                  'error', 'result']
+
+    def get_status_url(self, obj):
+        url = reverse('feature-job', args=[obj.pk])
+        request = self.context.get('request')
+        if request is not None:
+            return request.build_absolute_uri(url)
+        return url
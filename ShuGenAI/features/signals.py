@@ -1,6 +1,26 @@
-from django.db.models.signals import post_migrate
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_migrate, post_save, post_delete, m2m_changed
 from django.dispatch import receiver
-from features.models import Feature, Plans
+from features import entitlements, rollups
+from features.models import Feature, Plans, Subscription
+
+# Category of every feature; migration 0009 keeps a frozen copy of the categories at the time
+FEATURE_CATEGORIES = {
+    Feature.CATEGORY_TEXT: [
+        'generate_summary', 'rewrite_text', 'essay_writer', 'paragraph_writer', 'grammar_checker', 'post_writer',
+        'document_code',
+    ],
+    Feature.CATEGORY_IMAGE: [
+        'black_and_white', 'round_image', 'pixelate_image', 'blur_image', 'compress_image', 'remove_background',
+        'edit_background', 'pick_up_object', 'cut_out_object',
+    ],
+    Feature.CATEGORY_FILE: [
+        'pdf_to_docx', 'heif_to_jpg', 'png_to_jpg', 'raw_to_jpg', 'tiff_to_jpg', 'xml_to_json', 'json_to_xml',
+        'xml_to_csv', 'json_to_csv', 'xls_to_csv', 'xls_to_json', 'xls_to_xml', 'docx_to_pdf', 'compress_pdf',
+        'mp4_to_gif', 'mkv_to_mp4', 'mp4_to_mp3', 'compress_mp4',
+    ],
+}
 
 @receiver(post_migrate)
 def create_features_and_plans(sender, **kwargs):
@@ -81,6 +101,10 @@ def create_features_and_plans(sender, **kwargs):
     pro_functions.append(cut_out_object)
     pro_functions = pro_functions + advanced_functions
 
+    # Categorize the new features, the ones set already (e.g. in the admin) are left alone
+    for category, keys in FEATURE_CATEGORIES.items():
+        Feature.objects.filter(key__in=keys, category="").update(category=category)
+
     # Step 2: Create plans and assign features
     trial_plan, _ = Plans.objects.get_or_create(key="trial")
     trial_plan.features.set(pro_functions)
@@ -90,3 +114,30 @@ def create_features_and_plans(sender, **kwargs):
 
     pro_plan, _ = Plans.objects.get_or_create(key="pro")
     pro_plan.features.set(pro_functions)
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def invalidate_subscription_entitlements(sender, instance, **kwargs):
+    # Once more after the commit, in case a concurrent request cached the old rows in between
+    entitlements.invalidate(instance.user_id)
+    transaction.on_commit(lambda: entitlements.invalidate(instance.user_id))
+
+
+@receiver(m2m_changed, sender=Plans.features.through)
+@receiver(post_delete, sender=Plans)
+def invalidate_plan_entitlements(sender, **kwargs):
+    # A plan is shared by many users, start over for everyone
+    entitlements.invalidate_all()
+    transaction.on_commit(entitlements.invalidate_all)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def count_signup(sender, instance, created, **kwargs):
+    if created:
+        rollups.record_signup()
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def count_deleted_user(sender, instance, **kwargs):
+    rollups.record_signup(-1)
@@ -0,0 +1,21 @@
+import uuid
+
+from django.core.files.storage import FileSystemStorage
+from django.utils import timezone
+
+# Names from sharded_name() are unique already, so the storage does not have to probe
+# for a free one with exists() on every save
+output_storage = FileSystemStorage(allow_overwrite=True)
+
+
+def sharded_name(directory, filename):
+    """Return a unique storage name, spread over one directory per day and 256 per day below it.
+
+    The file name is kept at the end so that downloads still get a meaningful name.
+    """
+    token = uuid.uuid4().hex
+    return f"{directory}/{timezone.now():%Y/%m/%d}/{token[:2]}/{token[2:]}_{filename}"
+
+
+def history_upload_to(instance, filename):
+    return sharded_name("history", filename)
@@ -1,3 +1,469 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import pandas as pd
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from features import entitlements, history_journal, jobs, result_cache, retention, rollups, usage
+from features.jobs import build_feature_request
+from features.models import (CachedResult, Feature, FeatureJob, FeatureUsageRollup, History, Plans, RecentFeature,
+                             Subscription)
+from features.views import determine_feature
+from users.models import User
+
+MEDIA_ROOT = tempfile.mkdtemp()
+# Admission lock files and the history journal, kept out of the repository's tmp/
+TMP_DIR = tempfile.mkdtemp()
+
+
+def make_upload(color=(200, 10, 10), size=(64, 48), name="photo.jpg", image_format="JPEG"):
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, format=image_format)
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+# Uses are counted and the cache evicted right away, the background threads would not see the test transaction
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, TMP_DIR=TMP_DIR, FEATURE_USAGE_FLUSH_INTERVAL=0,
+                   FEATURE_HISTORY_WRITE_BEHIND=False, FEATURE_CACHE_EVICT_INTERVAL=0)
+class FeatureTestCase(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+        shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+    def setUp(self):
+        # Ids are reused once a test is rolled back, the cache of another test's user must not leak
+        entitlements.invalidate_all()
+        # Summed again, the cached results of the previous test were rolled back
+        result_cache._size_total = None
+        self.user = User.objects.create(email="user@example.com")
+        Subscription.objects.create(user=self.user, plan=Plans.objects.get(key="pro"),
+                                    end_date=timezone.now() + timedelta(days=30))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=self.user).key}")
+
+    def run_feature(self, feature_key, params=None, **files):
+        # Straight to the handler: the async dispatcher runs it on a thread outside the test transaction
+        request = build_feature_request(self.user, params or {}, files.pop("file", None))
+        for field_name, uploaded in files.items():
+            request.FILES[field_name] = uploaded
+        return determine_feature(request, feature_key)
+
+
+class FakeImageAIUtils:
+    """Stands in for the segmentation model: the whole photo is the object, it is pasted on the background."""
+
+    def infer_image(self, image, language="en"):
+        return image, {}
+
+    def edit_background(self, image, background_image, predictions):
+        composite = background_image.copy()
+        composite.paste(image.crop((0, 0, image.width // 2, image.height)))
+        return composite
+
+
+class ResultCacheTests(FeatureTestCase):
+    def test_custom_backgrounds_are_part_of_the_key(self):
+        with mock.patch("utilities.ai_models.get_image_ai_utils", return_value=FakeImageAIUtils()):
+            first = self.run_feature("edit_background", file=make_upload(),
+                                     background_file=make_upload((0, 0, 255), name="blue.jpg"))
+            second = self.run_feature("edit_background", file=make_upload(),
+                                      background_file=make_upload((0, 255, 0), name="green.jpg"))
+            again = self.run_feature("edit_background", file=make_upload(),
+                                     background_file=make_upload((0, 0, 255), name="blue.jpg"))
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertNotIn("X-Feature-Cache", second)
+        self.assertNotEqual(first.history.file.name, second.history.file.name)
+        self.assertEqual(again["X-Feature-Cache"], "HIT")
+        self.assertEqual(again.history.file.name, first.history.file.name)
+
+    def test_same_input_and_parameters_are_served_from_the_cache(self):
+        first = self.run_feature("blur_image", {"blur_intensity": "3"}, file=make_upload())
+        again = self.run_feature("blur_image", {"blur_intensity": "3"}, file=make_upload())
+        other = self.run_feature("blur_image", {"blur_intensity": "4"}, file=make_upload())
+        self.assertEqual(first.status_code, 201)
+        self.assertNotIn("X-Feature-Cache", first)
+        self.assertEqual(again["X-Feature-Cache"], "HIT")
+        self.assertEqual(again.history.file.name, first.history.file.name)
+        self.assertNotIn("X-Feature-Cache", other)
+        self.assertNotEqual(other.history.file.name, first.history.file.name)
+        # Every call is in the history, hits included
+        self.assertEqual(History.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(CachedResult.objects.get(file=first.history.file.name).hits, 1)
+
+    def test_missing_output_is_a_miss(self):
+        first = self.run_feature("blur_image", {"blur_intensity": "3"}, file=make_upload())
+        first.history.file.storage.delete(first.history.file.name)
+        again = self.run_feature("blur_image", {"blur_intensity": "3"}, file=make_upload())
+        self.assertNotIn("X-Feature-Cache", again)
+        self.assertTrue(again.history.file.storage.exists(again.history.file.name))
+
+    def test_eviction_keeps_a_running_size(self):
+        with override_settings(FEATURE_CACHE_MAX_BYTES=10 ** 9):
+            outputs = [self.run_feature("blur_image", {"blur_intensity": str(radius)}, file=make_upload())
+                       for radius in (1, 2, 3)]
+        sizes = [response.history.file.size for response in outputs]
+        self.assertEqual(result_cache._size_total, sum(sizes))
+        # Only the two most recently used results fit, and no other sum of the table is needed to know it
+        with override_settings(FEATURE_CACHE_MAX_BYTES=sizes[1] + sizes[2]), self.assertNumQueries(3):
+            self.assertEqual(result_cache.evict(), 1)
+        self.assertEqual(list(CachedResult.objects.order_by("id").values_list("size", flat=True)), sizes[1:])
+        self.assertEqual(result_cache._size_total, sum(sizes[1:]))
+
+    @override_settings(FEATURE_CACHE_EVICT_INTERVAL=3600)
+    @mock.patch("features.result_cache._ensure_evictor")
+    def test_eviction_is_left_to_the_evictor(self, ensure_evictor):
+        with override_settings(FEATURE_CACHE_MAX_BYTES=0):
+            response = self.run_feature("blur_image", {"blur_intensity": "3"}, file=make_upload())
+        ensure_evictor.assert_called_once()
+        self.assertTrue(CachedResult.objects.filter(file=response.history.file.name).exists())
+
+    def test_key_covers_every_upload_by_field_name(self):
+        def key(**files):
+            request = build_feature_request(self.user, {}, files.pop("file"))
+            for field_name, uploaded in files.items():
+                request.FILES[field_name] = uploaded
+            return result_cache.build_cache_key(request, "edit_background")
+
+        photo_only = key(file=make_upload())
+        with_background = key(file=make_upload(), background_file=make_upload((0, 0, 255)))
+        self.assertNotEqual(photo_only, with_background)
+        self.assertEqual(with_background, key(file=make_upload(), background_file=make_upload((0, 0, 255))))
+        # The same bytes under another field name are another input
+        self.assertNotEqual(with_background, key(file=make_upload(), mask_file=make_upload((0, 0, 255))))
+
+
+class PipelineTests(FeatureTestCase):
+    def post_pipeline(self, steps, uploaded, **params):
+        return self.client.post("/features/pipeline/", {"steps": steps, "file": uploaded, **params})
+
+    def test_table_steps_must_connect(self):
+        response = self.post_pipeline("xml_to_csv,xls_to_json", SimpleUploadedFile("table.xml", b"<a/>"))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("xls_to_json reads xls", response.json()["error"])
+
+    def test_connected_table_steps_run(self):
+        buffer = BytesIO()
+        pd.DataFrame({"id": [1, 2], "name": ["a", "b"]}).to_excel(buffer, index=False)
+        response = self.post_pipeline("xls_to_json,json_to_csv", SimpleUploadedFile("table.xlsx", buffer.getvalue()))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["steps"], ["xls_to_json", "json_to_csv"])
+        history = History.objects.get(user=self.user)
+        self.assertEqual(history.feature.key, "json_to_csv")
+        self.assertTrue(history.file.name.endswith("table.csv"))
+        with history.file.open("rb") as output:
+            self.assertEqual(output.read().decode("utf-8").splitlines(), ["id,name", "1,a", "2,b"])
+
+    def test_upload_conversions_only_come_first(self):
+        response = self.post_pipeline("black_and_white,tiff_to_jpg",
+                                      make_upload(name="photo.tiff", image_format="TIFF"))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("tiff_to_jpg", response.json()["error"])
+        self.assertFalse(History.objects.exists())
+
+        response = self.post_pipeline("tiff_to_jpg,black_and_white",
+                                      make_upload(name="photo.tiff", image_format="TIFF"))
+        self.assertEqual(response.status_code, 201)
+        with History.objects.get(user=self.user).file.open("rb") as output:
+            self.assertEqual(Image.open(output).mode, "L")
+
+
+class RecentFeaturesTests(FeatureTestCase):
+    def use(self, feature_key, minutes_ago):
+        history = History(user=self.user, feature=Feature.objects.get(key=feature_key),
+                          date=timezone.now() - timedelta(minutes=minutes_ago))
+        history_journal.save_history(None, history)
+        return history
+
+    def recent_keys(self):
+        response = self.client.get("/features/features/recent/")
+        self.assertEqual(response.status_code, 200)
+        return [feature["key"] for feature in response.json()]
+
+    def test_latest_use_of_each_feature_first(self):
+        for feature_key, minutes_ago in [("blur_image", 50), ("black_and_white", 40), ("blur_image", 5),
+                                         ("round_image", 30), ("pixelate_image", 20), ("xml_to_csv", 10),
+                                         ("json_to_csv", 60)]:
+            self.use(feature_key, minutes_ago)
+        self.assertEqual(self.recent_keys(),
+                         ["blur_image", "xml_to_csv", "pixelate_image", "round_image", "black_and_white"])
+        self.assertEqual(RecentFeature.objects.filter(user=self.user).count(), 6)
+
+    def test_ties_are_broken_by_the_latest_first_use(self):
+        date = timezone.now()
+        for feature_key in ("blur_image", "round_image", "black_and_white"):
+            history_journal.save_history(None, History(user=self.user, feature=Feature.objects.get(key=feature_key),
+                                                       date=date))
+        self.assertEqual(self.recent_keys(), ["black_and_white", "round_image", "blur_image"])
+
+    def test_replayed_older_uses_do_not_move_back(self):
+        latest = self.use("blur_image", 1)
+        history_journal._insert_missing([History(user=self.user, feature=latest.feature,
+                                                 date=latest.date - timedelta(days=1))])
+        self.assertEqual(RecentFeature.objects.get(user=self.user).last_used, latest.date)
+        self.assertEqual(History.objects.filter(user=self.user).count(), 2)
+
+
+class JobRecoveryTests(FeatureTestCase):
+    def claim(self, minutes_ago=0):
+        FeatureJob.objects.create(user=self.user, feature=Feature.objects.get(key="blur_image"))
+        job = jobs.claim_next_job()
+        FeatureJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(minutes=minutes_ago))
+        return job
+
+    def test_jobs_of_stopped_workers_are_queued_again(self):
+        job = self.claim(minutes_ago=10)
+        self.assertEqual(jobs.recover_stale_jobs(stale_after=300, max_attempts=2), (1, 0))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.started_at), (FeatureJob.STATUS_PENDING, None))
+        self.assertEqual(jobs.claim_next_job().attempts, 2)
+
+    def test_jobs_with_heartbeats_are_left_running(self):
+        job = self.claim(minutes_ago=10)
+        jobs.heartbeat([job.pk])
+        self.assertEqual(jobs.recover_stale_jobs(stale_after=300, max_attempts=2), (0, 0))
+        job.refresh_from_db()
+        self.assertEqual(job.status, FeatureJob.STATUS_RUNNING)
+
+    def test_jobs_are_failed_after_the_last_attempt(self):
+        job = self.claim(minutes_ago=10)
+        FeatureJob.objects.filter(pk=job.pk).update(attempts=2)
+        self.assertEqual(jobs.recover_stale_jobs(stale_after=300, max_attempts=2), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual(job.status, FeatureJob.STATUS_FAILED)
+        self.assertIsNotNone(job.finished_at)
+        self.assertIsNone(jobs.claim_next_job())
+
+
+class RollupTests(FeatureTestCase):
+    def use(self, feature_key, days_ago=0):
+        history_journal.save_history(None, History(user=self.user, feature=Feature.objects.get(key=feature_key),
+                                                   date=timezone.now() - timedelta(days=days_ago)))
+
+    def test_uses_are_counted_per_day_and_category(self):
+        for feature_key, days_ago in [("blur_image", 0), ("blur_image", 0), ("blur_image", 1), ("xml_to_csv", 0)]:
+            self.use(feature_key, days_ago)
+        today = timezone.localdate()
+        blur_image = Feature.objects.get(key="blur_image")
+        self.assertEqual(FeatureUsageRollup.objects.get(day=today, feature=blur_image).count, 2)
+        self.assertEqual(FeatureUsageRollup.objects.get(day=today - timedelta(days=1), feature=blur_image).count, 1)
+        counts = rollups.usage_by_category()
+        self.assertEqual((counts["image"], counts["file"], counts["text"]), (3, 1, 0))
+        self.assertEqual(rollups.usage_by_category(date_from=today)["image"], 2)
+
+    @override_settings(FEATURE_USAGE_FLUSH_INTERVAL=3600)
+    @mock.patch("features.usage._ensure_flusher")
+    def test_buffered_until_the_flush(self, ensure_flusher):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.use("blur_image")
+            self.use("blur_image")
+        self.assertFalse(FeatureUsageRollup.objects.exists())
+        usage.flush()
+        self.assertEqual(FeatureUsageRollup.objects.get().count, 2)
+        ensure_flusher.assert_called()
+
+    @override_settings(FEATURE_USAGE_FLUSH_INTERVAL=3600)
+    @mock.patch("features.usage._ensure_flusher")
+    def test_rolled_back_inserts_are_not_counted(self, ensure_flusher):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    self.use("blur_image")
+                    raise DatabaseError
+            except DatabaseError:
+                pass
+        self.assertEqual(callbacks, [])
+        usage.flush()
+        self.assertFalse(FeatureUsageRollup.objects.exists())
+
+
+class HistoryPaginationTests(FeatureTestCase):
+    def test_pages_cover_every_row_once(self):
+        blur_image = Feature.objects.get(key="blur_image")
+        date = timezone.now()
+        # Rows sharing a date are told apart by the id kept in the cursor
+        histories = [History.objects.create(user=self.user, feature=blur_image, date=date) for _ in range(3)]
+        histories += [History.objects.create(user=self.user, feature=blur_image, date=date - timedelta(minutes=minutes))
+                      for minutes in (1, 2)]
+        History.objects.create(user=User.objects.create(email="other@example.com"), feature=blur_image, date=date)
+
+        ids, url = [], "/features/user-history/?page_size=2&fields=light"
+        while url:
+            page = self.client.get(url).json()
+            self.assertLessEqual(len(page["results"]), 2)
+            ids += [history["id"] for history in page["results"]]
+            url = page["next"]
+        expected = sorted(histories, key=lambda history: (history.date, history.id), reverse=True)
+        self.assertEqual(ids, [history.id for history in expected])
+
+        # And back again through the previous links, from the last page
+        pages, url = [[history["id"] for history in page["results"]]], page["previous"]
+        while url:
+            page = self.client.get(url).json()
+            pages.insert(0, [history["id"] for history in page["results"]])
+            url = page["previous"]
+        self.assertEqual([id for ids in pages for id in ids], [history.id for history in expected])
+
+    def test_pages_are_read_without_an_offset(self):
+        blur_image = Feature.objects.get(key="blur_image")
+        for _ in range(3):
+            History.objects.create(user=self.user, feature=blur_image)
+        first = self.client.get("/features/user-history/?page_size=1&fields=light").json()
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(first["next"]).json()
+        self.assertEqual(len(second["results"]), 1)
+        self.assertFalse([query for query in queries if "OFFSET" in query["sql"].upper()])
+
+    def test_invalid_cursor(self):
+        response = self.client.get("/features/user-history/?cursor=bm90LWEtY3Vyc29y")
+        self.assertEqual(response.status_code, 404)
+
+
+class EntitlementTests(FeatureTestCase):
+    def test_cached_until_the_subscription_changes(self):
+        self.assertIn("blur_image", entitlements.get_allowed_feature_keys(self.user))
+        with self.assertNumQueries(0):
+            self.assertIn("blur_image", entitlements.get_allowed_feature_keys(self.user))
+        # Saving or deleting a subscription drops the entry through the signals
+        Subscription.objects.get(user=self.user).delete()
+        self.assertEqual(entitlements.get_allowed_feature_keys(self.user), frozenset())
+
+    def test_queryset_updates_need_an_explicit_invalidation(self):
+        self.assertIn("blur_image", entitlements.get_allowed_feature_keys(self.user))
+        Subscription.objects.filter(user=self.user).update(end_date=timezone.now() - timedelta(days=1))
+        self.assertIn("blur_image", entitlements.get_allowed_feature_keys(self.user))
+        entitlements.invalidate(self.user.pk)
+        self.assertEqual(entitlements.get_allowed_feature_keys(self.user), frozenset())
+
+    def test_plan_changes_invalidate_every_user(self):
+        self.assertIn("blur_image", entitlements.get_allowed_feature_keys(self.user))
+        Plans.objects.get(key="pro").features.remove(Feature.objects.get(key="blur_image"))
+        self.assertNotIn("blur_image", entitlements.get_allowed_feature_keys(self.user))
+
+    def test_entries_expire_with_the_subscription(self):
+        Subscription.objects.filter(user=self.user).update(end_date=timezone.now() + timedelta(seconds=1))
+        entitlements.invalidate(self.user.pk)
+        with mock.patch("features.entitlements.time.time", return_value=timezone.now().timestamp()):
+            self.assertIn("blur_image", entitlements.get_allowed_feature_keys(self.user))
+        with mock.patch("features.entitlements.time.time", return_value=timezone.now().timestamp() + 2), \
+                self.assertNumQueries(1):
+            entitlements.get_allowed_feature_keys(self.user)
+
+
+@override_settings(FEATURE_USAGE_FLUSH_INTERVAL=3600)
+@mock.patch("features.usage._ensure_flusher")
+class UsageFlushTests(FeatureTestCase):
+    def used_count(self, feature_key):
+        return Feature.objects.get(key=feature_key).used_count
+
+    def test_uses_are_written_by_the_flush(self, ensure_flusher):
+        usage.record_use("blur_image", "blur_image", "xml_to_csv")
+        self.assertEqual((self.used_count("blur_image"), self.used_count("xml_to_csv")), (0, 0))
+        self.assertEqual(usage.pending_counts(), {"blur_image": 2, "xml_to_csv": 1})
+        feature, = usage.with_pending_counts(Feature.objects.filter(key="blur_image"))
+        self.assertEqual(feature.used_count, 2)
+        usage.flush()
+        self.assertEqual((self.used_count("blur_image"), self.used_count("xml_to_csv")), (2, 1))
+        self.assertEqual(usage.pending_counts(), {})
+
+    def test_failed_flush_keeps_the_uses(self, ensure_flusher):
+        usage.record_use("blur_image")
+        with mock.patch("features.usage._write", side_effect=DatabaseError), self.assertRaises(DatabaseError):
+            usage.flush()
+        self.assertEqual(usage.pending_counts(), {"blur_image": 1})
+        usage.flush()
+        self.assertEqual(self.used_count("blur_image"), 1)
+
+
+class JournalReplayTests(FeatureTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir, ignore_errors=True)
+        settings_override = override_settings(TMP_DIR=tmp_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write_segment(self, histories):
+        # What a process that died before flushing leaves behind
+        path = os.path.join(history_journal._journal_dir(), f"1-{uuid.uuid4().hex}.jsonl")
+        with open(path, "w") as segment:
+            for history in histories:
+                segment.write(json.dumps({
+                    "journal_id": str(history.journal_id), "user_id": history.user_id,
+                    "feature_id": history.feature_id, "file": history.file.name, "date": history.date.isoformat(),
+                }) + "\n")
+            # Cut short by the crash
+            segment.write('{"journal_id": ')
+        return path
+
+    def test_replay_inserts_each_record_once(self):
+        blur_image = Feature.objects.get(key="blur_image")
+        histories = [History(user=self.user, feature=blur_image, file=f"history/{number}.jpg", date=timezone.now(),
+                             journal_id=uuid.uuid4()) for number in range(3)]
+        # The first one made it into the database before the crash
+        history_journal.save_history(None, histories[0])
+        path = self.write_segment(histories)
+
+        history_journal.replay()
+        history_journal.replay()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(sorted(History.objects.values_list("file", flat=True)),
+                         ["history/0.jpg", "history/1.jpg", "history/2.jpg"])
+        self.assertEqual(FeatureUsageRollup.objects.get(feature=blur_image).count, 3)
+
+        # The same segment replayed again, e.g. by a second process, counts nothing twice
+        self.write_segment(histories)
+        history_journal.replay()
+        self.assertEqual(History.objects.count(), 3)
+        self.assertEqual(FeatureUsageRollup.objects.get(feature=blur_image).count, 3)
+
+
+class RetentionTests(FeatureTestCase):
+    def add_history(self, feature, days_ago, name=None):
+        if name is None:
+            name = default_storage.save(f"history/{uuid.uuid4().hex}.jpg", ContentFile(b"output"))
+        history = History(user=self.user, feature=feature, file=name, date=timezone.now() - timedelta(days=days_ago))
+        history_journal.save_history(None, history)
+        return history
+
+    def test_purge_deletes_expired_rows_and_unshared_files(self):
+        blur_image = Feature.objects.get(key="blur_image")
+        blur_image.retention_days = 30
+        blur_image.save()
+        xml_to_csv = Feature.objects.get(key="xml_to_csv")
+        expired = self.add_history(blur_image, 40)
+        # Served from the result cache, it shares the output of an expired row
+        shared = self.add_history(blur_image, 45)
+        kept = self.add_history(blur_image, 1, name=shared.file.name)
+        # Kept forever with the default FEATURE_HISTORY_RETENTION_DAYS of 0
+        old_xml_to_csv = self.add_history(xml_to_csv, 400)
+
+        self.assertEqual(retention.purge_expired_history(dry_run=True), (2, 1))
+        self.assertEqual(History.objects.count(), 4)
+        self.assertTrue(default_storage.exists(expired.file.name))
+
+        self.assertEqual(retention.purge_expired_history(batch_size=1), (2, 1))
+        self.assertEqual(set(History.objects.values_list("id", flat=True)), {kept.id, old_xml_to_csv.id})
+        self.assertFalse(default_storage.exists(expired.file.name))
+        self.assertTrue(default_storage.exists(kept.file.name))
+        self.assertEqual(retention.purge_expired_history(), (0, 0))
+        self.assertEqual(set(RecentFeature.objects.values_list("feature__key", flat=True)),
+                         {"blur_image", "xml_to_csv"})
@@ -1,7 +1,7 @@
 from django.urls import path
 from .views import (FeatureListView, PlansView,
-                    CreateSubscriptionView, UserSubscriptionView, process_feature,
-                    UserHistoryView, RecentFeaturesView)
+                    CreateSubscriptionView, UserSubscriptionView, dispatch_feature, process_pipeline,
+                    UserHistoryView, RecentFeaturesView, FeatureJobView)
 
 urlpatterns = [
     path('user-history/', UserHistoryView.as_view(), name='user-history'),
@@ -10,5 +10,7 @@ urlpatterns = [
     path('plans/', PlansView.as_view(), name='plans-list'),
     path('subscriptions/', CreateSubscriptionView.as_view(), name='create-subscription'),
     path('subscriptions/user/', UserSubscriptionView.as_view(), name='user-subscription'),
-    path('<str:feature_key>/', process_feature, name='process-feature'),
+    path('pipeline/', process_pipeline, name='process-pipeline'),
+    path('jobs/<int:job_id>/', FeatureJobView.as_view(), name='feature-job'),
+    path('<str:feature_key>/', dispatch_feature, name='process-feature'),
 ]
\ No newline at end of file
@@ -0,0 +1,135 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from .models import Feature
+
+logger = logging.getLogger(__name__)
+
+# feature key -> uses not written to Feature.used_count yet
+_pending = Counter()
+# (day, feature id) -> History rows not counted in FeatureUsageRollup yet
+_pending_rollups = Counter()
+_lock = threading.Lock()
+# Process that started the flusher thread; a forked child has to start its own
+_flusher_pid = None
+
+
+def record_use(*feature_keys):
+    """Count one use of each feature; the database is updated by the periodic flush."""
+    if settings.FEATURE_USAGE_FLUSH_INTERVAL <= 0:
+        # Unbuffered mode, the increment is part of the caller's transaction
+        _write(Counter(feature_keys))
+        return
+    with _lock:
+        _pending.update(feature_keys)
+    _ensure_flusher()
+
+
+def record_rollups(counts):
+    """Add ``{(day, feature_id): count}`` to the daily usage rollups with the next flush.
+
+    One process writes a day's row of a feature once per flush instead of once per request,
+    the row every request of the day would otherwise wait on.
+    """
+    if settings.FEATURE_USAGE_FLUSH_INTERVAL <= 0:
+        _write_rollups(counts)
+        return
+    # Only once the rows are in, a batch of the history journal that is rolled back is counted on its replay
+    transaction.on_commit(lambda: _buffer_rollups(counts))
+
+
+def _buffer_rollups(counts):
+    with _lock:
+        _pending_rollups.update(counts)
+    _ensure_flusher()
+
+
+def pending_counts():
+    with _lock:
+        return dict(_pending)
+
+
+def with_pending_counts(features):
+    # Return the features loaded from the database with the uses still buffered in this process added
+    pending = pending_counts()
+    features = list(features)
+    for feature in features:
+        feature.used_count += pending.get(feature.key, 0)
+    return features
+
+
+def flush():
+    with _lock:
+        batches = [(_pending, _pending.copy(), _write), (_pending_rollups, _pending_rollups.copy(), _write_rollups)]
+        _pending.clear()
+        _pending_rollups.clear()
+    error = None
+    for pending, counts, write in batches:
+        if not counts:
+            continue
+        try:
+            write(counts)
+        except Exception as e:
+            # Keep the uses for the next attempt rather than losing them
+            with _lock:
+                pending.update(counts)
+            error = error or e
+    if error is not None:
+        raise error
+
+
+def _write(counts):
+    # A single UPDATE for the whole batch, every row incremented atomically by its own amount
+    Feature.objects.filter(key__in=counts).update(
+        used_count=F("used_count") + Case(
+            *[When(key=key, then=Value(count)) for key, count in counts.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+    )
+
+
+def _write_rollups(counts):
+    # Imported here, rollups records through this module
+    from . import rollups
+
+    rollups.write(counts)
+
+
+def _ensure_flusher():
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_run_flusher, name="feature-usage-flusher", daemon=True).start()
+
+
+def _run_flusher():
+    while True:
+        time.sleep(settings.FEATURE_USAGE_FLUSH_INTERVAL)
+        close_old_connections()
+        try:
+            flush()
+        except Exception:
+            logger.exception("Failed to flush feature usage counts")
+        finally:
+            connection.close()
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception:
+        logger.exception("Failed to flush feature usage counts at exit")
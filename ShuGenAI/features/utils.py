@@ -0,0 +1,34 @@
+from django.http import JsonResponse
+from rest_framework import status
+from utilities import metrics
+
+from . import history_journal, usage
+from .models import Feature, History
+from .serializers import HistorySerializer
+
+
+def save_feature_history(request, feature_key, content_file, extra_data=None):
+    # Get the user and feature, assuming the user is authenticated
+    user = request.user if request.user.is_authenticated else None
+    # Write the output to the storage first so that its time is measured apart from the DB work
+    history = History(user=user)
+    with metrics.stage("storage"):
+        history.file.save(content_file.name, content_file, save=False)
+    metrics.observe_output_size(history.file.size)
+    with metrics.stage("history_insert"):
+        feature = Feature.objects.get(key=feature_key)
+        # Create and save the History instance, or journal it for a later bulk insert
+        history.feature = feature
+        history_journal.save_history(request, history)
+    usage.record_use(feature_key)
+    # The serialized feature shows the uses still buffered, this one included
+    history.feature, = usage.with_pending_counts([feature])
+    # Serialize the History instance
+    serializer = HistorySerializer(history, context={'request': request})
+    response_data = serializer.data
+    if extra_data:
+        response_data.update(extra_data)
+    # Return the serialized data
+    response = JsonResponse(response_data, status=status.HTTP_201_CREATED)
+    response.history = history
+    return response
@@ -1,18 +1,28 @@
-from collections import OrderedDict
-from datetime import timedelta
+from datetime import datetime, time, timedelta
+from asgiref.sync import sync_to_async
+from rest_framework.authentication import TokenAuthentication
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from django.shortcuts import get_object_or_404
-from .models import Feature, History, Plans, Subscription
+from django.db import close_old_connections
+from .models import Feature, History, Plans, Subscription, FeatureJob, RecentFeature
 from django.contrib.auth import get_user_model
-from .serializers import (FeatureSerializer, HistorySerializer,
-                          PlansSerializer, SubscriptionSerializer, FeatureKeySerializer)
+from .serializers import (FeatureSerializer, HistorySerializer, HistoryLightSerializer,
+                          PlansSerializer, SubscriptionSerializer, FeatureKeySerializer,
+                          FeatureJobSerializer)
+from .pagination import HistoryCursorPagination
+from .jobs import wants_async, enqueue_feature_job
+from . import result_cache, admission, entitlements, usage
+from .utils import save_feature_history
 from django.http import JsonResponse
 from django.utils import timezone
-from utilities import file_utils, text_utils, image_utils
+from django.utils.dateparse import parse_date, parse_datetime
+from django.views.decorators.csrf import csrf_exempt
+from utilities import file_utils, text_utils, image_utils, metrics
 
 
 User = get_user_model()
@@ -21,7 +31,8 @@ class FeatureListView(APIView):
     permission_classes = [AllowAny]
     def get(self, request):
         features = Feature.objects.all()  # Fetch all Feature instances
-        serializer = FeatureSerializer(features, many=True)
+        # Include the uses this process has counted but not flushed yet
+        serializer = FeatureSerializer(usage.with_pending_counts(features), many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 class PlansView(APIView):
@@ -51,6 +62,8 @@ class CreateSubscriptionView(APIView):
         elif Subscription.objects.filter(user=request.user).exists():
             Subscription.objects.filter(user=request.user).update(plan=plan,
                                                                   end_date=timezone.now() + timedelta(days=int(duration)))
+            # Queryset updates send no signals, drop the cached entitlements by hand
+            entitlements.invalidate(request.user.pk)
             subscription = Subscription.objects.get(user=request.user, plan=plan)
         else:
             subscription = Subscription.objects.create(
@@ -88,15 +101,58 @@ class UserSubscriptionView(APIView):
 class UserHistoryView(APIView):
     permission_classes = [IsAuthenticated]  # Ensure user is authenticated
 
+    CATEGORIES = [category for category, _ in Feature.CATEGORY_CHOICES]
+
     def get(self, request):
         # Filter history for the authenticated user
-        user_history = History.objects.filter(user=request.user)
-
-        # Serialize the user's history
-        serializer = HistorySerializer(user_history, many=True, context={'request': request})
+        user_history = History.objects.filter(user=request.user).select_related('feature')
+
+        # Optional filters: ?feature=key1,key2 &category=text|image|file &date_from=... &date_to=...
+        feature_keys = [key for key in request.query_params.get('feature', '').split(',') if key]
+        if feature_keys:
+            user_history = user_history.filter(feature__key__in=feature_keys)
+        category = request.query_params.get('category')
+        if category:
+            if category not in self.CATEGORIES:
+                return Response({"error": f"Unknown category: {category}"}, status=status.HTTP_400_BAD_REQUEST)
+            user_history = user_history.filter(feature__category=category)
+        try:
+            date_from = parse_history_date(request.query_params.get('date_from'))
+            date_to = parse_history_date(request.query_params.get('date_to'), end_of_day=True)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if date_from:
+            user_history = user_history.filter(date__gte=date_from)
+        if date_to:
+            user_history = user_history.filter(date__lt=date_to)
+
+        # One page at a time, ordered by (date, id)
+        paginator = HistoryCursorPagination()
+        page = paginator.paginate_queryset(user_history, request, view=self)
+
+        # Serialize the user's history; ?fields=light skips the nested feature and absolute URLs
+        if request.query_params.get('fields') == 'light':
+            serializer = HistoryLightSerializer(page, many=True)
+        else:
+            serializer = HistorySerializer(page, many=True, context={'request': request})
 
         # Return the serialized data
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
+
+
+def parse_history_date(value, end_of_day=False):
+    # Accepts a date or a datetime; a bare date_to includes the whole day
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is not None:
+        return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+    parsed_date = parse_date(value)
+    if parsed_date is None:
+        raise ValueError(f"Invalid date: {value}")
+    if end_of_day:
+        parsed_date += timedelta(days=1)
+    return timezone.make_aware(datetime.combine(parsed_date, time.min))
 
 
 
@@ -104,89 +160,207 @@ class RecentFeaturesView(APIView):
     permission_classes = [IsAuthenticated]  # Ensure user is authenticated
 
     def get(self, request):
-        # Get the user's history, ordered by most recent date
-        recent_features = (
-            History.objects.filter(user=request.user)
-            .select_related('feature')  # Optimize query by selecting related feature
-            .order_by('-date')
-        )
-
-        # Use an ordered dict to keep unique features while preserving order
-        unique_features = OrderedDict()
-        for history in recent_features:
-            if history.feature_id not in unique_features:
-                unique_features[history.feature_id] = history.feature
-
-            # Stop if we have 5 unique features
-            if len(unique_features) == 5:
-                break
+        # The five features used last, read from their per-user last use; the id breaks ties
+        recent_features = [
+            recent.feature for recent in
+            RecentFeature.objects.filter(user=request.user).select_related('feature').order_by('-last_used', '-id')[:5]
+        ]
 
         # Serialize the unique features
-        serializer = FeatureKeySerializer(unique_features.values(), many=True)
+        serializer = FeatureKeySerializer(recent_features, many=True)
 
         # Return the serialized data
         return Response(serializer.data)
 
 
+class FeatureJobView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        # Users can only poll their own jobs
+        job = get_object_or_404(FeatureJob.objects.select_related('feature', 'history__feature'),
+                                pk=job_id, user=request.user)
+        serializer = FeatureJobSerializer(job, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+@csrf_exempt
+async def dispatch_feature(request, feature_key):
+    # LLM text features are served on the event loop; everything else keeps the sync DRF view,
+    # run in a worker thread so that CPU-bound handlers do not serialize on the loop's sync thread
+    if feature_key in text_utils.TEXT_FEATURES and request.method == "POST" and not wants_async(request):
+        return await process_text_feature(request, feature_key)
+    return await sync_to_async(process_feature_in_worker_thread, thread_sensitive=False)(request, feature_key)
+
+
+def process_feature_in_worker_thread(request, feature_key):
+    # Django closes the connections of the request's own thread when it finishes, not the ones opened
+    # by the executor threads: do it here, like the request_started and request_finished handlers would
+    close_old_connections()
+    try:
+        return process_feature(request, feature_key)
+    finally:
+        close_old_connections()
+
+
+async def process_text_feature(request, feature_key):
+    # Same checks as process_feature, done without holding a thread during the LLM call
+    try:
+        authenticated = await sync_to_async(TokenAuthentication().authenticate)(request)
+    except AuthenticationFailed as e:
+        return JsonResponse({"detail": str(e.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+    if authenticated is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."},
+                            status=status.HTTP_401_UNAUTHORIZED)
+    request.user = authenticated[0]
+
+    if feature_key not in await sync_to_async(entitlements.get_allowed_feature_keys)(request.user):
+        if not await Feature.objects.filter(key=feature_key).aexists():
+            return JsonResponse({"detail": "No Feature matches the given query."}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse({"status": "error", "message": "Access denied to this feature."}, status=403)
+
+    with metrics.feature_span(feature_key, metrics.get_input_size(request)) as span:
+        try:
+            async with admission.admit_async(feature_key):
+                response = await text_utils.agenerate_text(request, feature_key)
+        except admission.FeatureBusy as e:
+            response = admission.busy_response(e)
+        span.status = response.status_code
+    return response
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])  # Ensure the user is authenticated
 def process_feature(request, feature_key):
-    # Step 1: Verify if the feature exists
-    feature = get_object_or_404(Feature, key=feature_key)
-
-    # Step 2: Check if the user has an active subscription with a plan that includes this feature
+    # Step 1: Check if the user has an active subscription with a plan that includes this feature
     if not request.user.is_authenticated:
         return Response({"status": "error", "message": "User is not authenticated"}, status=401)
-    user_subscriptions = Subscription.objects.filter(
-        user=request.user,
-        end_date__gt=timezone.now()  # Subscription must be active
-    ).select_related('plan').prefetch_related('plan__features')
+    if feature_key not in entitlements.get_allowed_feature_keys(request.user):
+        # Step 2: Only a denied key needs a lookup, to tell a missing feature from a forbidden one
+        get_object_or_404(Feature, key=feature_key)
+        return Response({"status": "error", "message": "Access denied to this feature."}, status=403)
+
+    # Heavy features can be queued for the job workers instead of running inside the request
+    if wants_async(request):
+        job = enqueue_feature_job(request, Feature.objects.get(key=feature_key))
+        serializer = FeatureJobSerializer(job, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+    # Proceed with your additional logic if feature access is confirmed
+    return determine_feature(request, feature_key)
 
-    # Step 3: Verify if any subscription includes the feature
-    has_access = any(feature in subscription.plan.features.all() for subscription in user_subscriptions)
 
-    if has_access:
-        # Proceed with your additional logic if feature access is confirmed
-        return determine_feature(request, feature_key)
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def process_pipeline(request):
+    # Ordered, comma separated feature keys, e.g. "heif_to_jpg,compress_image,round_image"
+    steps = [key.strip() for key in request.POST.get('steps', '').split(',') if key.strip()]
+    uploaded_file = request.FILES.get('file')
+    if not steps or uploaded_file is None:
+        return Response({"error": "Invalid request, steps and file are required"}, status=status.HTTP_400_BAD_REQUEST)
+
+    # All steps must work on the same in-memory representation
+    if all(key in image_utils.IMAGE_PIPELINE_STEPS for key in steps):
+        validate_pipeline, run_pipeline = image_utils.validate_image_pipeline, image_utils.run_image_pipeline
+    elif all(key in file_utils.TABLE_PIPELINE_STEPS for key in steps):
+        validate_pipeline, run_pipeline = file_utils.validate_table_pipeline, file_utils.run_table_pipeline
     else:
+        return Response({"error": f"These features can not be chained: {', '.join(steps)}"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    # Only the first step reads the upload and only the last one writes, the ones between must connect
+    try:
+        validate_pipeline(steps)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Check the entitlement once for the whole chain
+    if not set(steps) <= entitlements.get_allowed_feature_keys(request.user):
         return Response({"status": "error", "message": "Access denied to this feature."}, status=403)
 
+    # Chains are measured as one "pipeline" feature to keep the number of series bounded
+    with metrics.feature_span("pipeline", uploaded_file.size) as span:
+        try:
+            with admission.admit(steps[0]):
+                output_file = run_pipeline(uploaded_file, steps, request.POST)
+        except admission.FeatureBusy as e:
+            span.status = status.HTTP_429_TOO_MANY_REQUESTS
+            return admission.busy_response(e)
+        except image_utils.ImageTooLarge as e:
+            span.status = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            return image_utils.too_large_response(e)
+        except Exception as e:
+            span.status = status.HTTP_400_BAD_REQUEST
+            return Response({"error": f"Error processing file: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Only the final output is stored; it is recorded under the last step of the chain
+        usage.record_use(*steps[:-1])
+        response = save_feature_history(request, steps[-1], output_file, extra_data={"steps": steps})
+        span.status = response.status_code
+    return response
+
+
+# Handler of every feature served by determine_feature
+FEATURES_DICT = {"black_and_white": image_utils.convert_image_to_bw,
+                 "round_image": image_utils.convert_image_to_round,
+                 "pixelate_image": image_utils.convert_image_to_pixelated,
+                 "blur_image": image_utils.convert_image_to_blurred,
+                 "compress_image": image_utils.compress_image,
+                 "heif_to_jpg": image_utils.convert_heic_to_jpg,
+                 "png_to_jpg": image_utils.convert_png_to_jpg,
+                 "raw_to_jpg": image_utils.convert_raw_to_jpg,
+                 "tiff_to_jpg": image_utils.convert_tiff_to_jpg,
+                 "xml_to_json": file_utils.convert_xml_to_json,
+                 "json_to_xml": file_utils.convert_json_to_xml,
+                 "xml_to_csv": file_utils.convert_xml_to_csv,
+                 "json_to_csv": file_utils.convert_json_to_csv,
+                 "xls_to_csv": file_utils.convert_xls_to_csv,
+                 "xls_to_json": file_utils.convert_xls_to_json,
+                 "xls_to_xml": file_utils.convert_xls_to_xml,
+                 "pdf_to_docx": file_utils.convert_pdf_to_docx,
+                 "docx_to_pdf": file_utils.convert_docx_to_pdf,
+                 "compress_pdf": file_utils.pdf_compression,
+                 "mp4_to_gif": file_utils.convert_mp4_to_gif,
+                 "mkv_to_mp4": file_utils.convert_mkv_to_mp4,
+                 "mp4_to_mp3": file_utils.convert_mp4_to_mp3,
+                 "compress_mp4": file_utils.compress_mp4,
+                 "generate_summary": text_utils.generate_summary,
+                 "rewrite_text": text_utils.rewrite_text,
+                 "essay_writer": text_utils.essay_writer,
+                 "paragraph_writer": text_utils.paragraph_writer,
+                 "grammar_checker": text_utils.grammar_checker,
+                 "post_writer": text_utils.post_writer,
+                 "document_code": text_utils.document_code,
+                 "remove_background": image_utils.remove_background,
+                 "edit_background": image_utils.edit_background,
+                 "pick_up_object": image_utils.pick_up_object,
+                 "cut_out_object": image_utils.cut_out_object,
+                 }
+
 
 def determine_feature(request, feature_key):
-    FEATURES_DICT = {"black_and_white": image_utils.convert_image_to_bw,
-                     "round_image": image_utils.convert_image_to_round,
-                     "pixelate_image": image_utils.convert_image_to_pixelated,
-                     "blur_image": image_utils.convert_image_to_blurred,
-                     "compress_image": image_utils.compress_image,
-                     "heif_to_jpg": image_utils.convert_heic_to_jpg,
-                     "png_to_jpg": image_utils.convert_png_to_jpg,
-                     "raw_to_jpg": image_utils.convert_raw_to_jpg,
-                     "tiff_to_jpg": image_utils.convert_tiff_to_jpg,
-                     "xml_to_json": file_utils.convert_xml_to_json,
-                     "json_to_xml": file_utils.convert_json_to_xml,
-                     "xml_to_csv": file_utils.convert_xml_to_csv,
-                     "json_to_csv": file_utils.convert_json_to_csv,
-                     "xls_to_csv": file_utils.convert_xls_to_csv,
-                     "xls_to_json": file_utils.convert_xls_to_json,
-                     "xls_to_xml": file_utils.convert_xls_to_xml,
-                     "pdf_to_docx": file_utils.convert_pdf_to_docx,
-                     "docx_to_pdf": file_utils.convert_docx_to_pdf,
-                     "compress_pdf": file_utils.pdf_compression,
-                     "mp4_to_gif": file_utils.convert_mp4_to_gif,
-                     "mkv_to_mp4": file_utils.convert_mkv_to_mp4,
-                     "mp4_to_mp3": file_utils.convert_mp4_to_mp3,
-                     "compress_mp4": file_utils.compress_mp4,
-                     "generate_summary": text_utils.generate_summary,
-                     "rewrite_text": text_utils.rewrite_text,
-                     "essay_writer": text_utils.essay_writer,
-                     "paragraph_writer": text_utils.paragraph_writer,
-                     "grammar_checker": text_utils.grammar_checker,
-                     "post_writer": text_utils.post_writer,
-                     "document_code": text_utils.document_code,
-                     "remove_background": image_utils.remove_background,
-                     "edit_background": image_utils.edit_background,
-                     "pick_up_object": image_utils.pick_up_object,
-                     "cut_out_object": image_utils.cut_out_object,
-                     }
-
-    return FEATURES_DICT[feature_key](request, feature_key)
\ No newline at end of file
+    with metrics.feature_span(feature_key, metrics.get_input_size(request)) as span:
+        response = run_feature(request, feature_key, FEATURES_DICT[feature_key])
+        span.status = response.status_code
+    return response
+
+
+def run_feature(request, feature_key, handler):
+    # Repeated calls with the same input and parameters are answered from the result cache
+    with metrics.stage("cache_lookup"):
+        cache_key = result_cache.build_cache_key(request, feature_key)
+        cached_response = result_cache.serve_cached(request, cache_key) if cache_key else None
+    if cached_response is not None:
+        return cached_response
+
+    # Queued jobs wait for a free slot, interactive requests get a fast 429 once the wait time is over
+    queued = getattr(request, "feature_job", None) is not None
+    try:
+        with admission.admit(feature_key, wait=None if queued else False):
+            response = handler(request, feature_key)
+    except admission.FeatureBusy as e:
+        return admission.busy_response(e)
+    except image_utils.ImageTooLarge as e:
+        return image_utils.too_large_response(e)
+    if cache_key and response.status_code == status.HTTP_201_CREATED:
+        with metrics.stage("cache_store"):
+            result_cache.store(cache_key, response)
+    return response
@@ -1,6 +1,7 @@
 from django.contrib import admin
-from .models import User, Card
+from .models import User, Card, UserSignupRollup
 
 # Register your models here.
 admin.site.register(User)
 admin.site.register(Card)
+admin.site.register(UserSignupRollup)
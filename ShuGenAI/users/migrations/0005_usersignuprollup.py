@@ -0,0 +1,40 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:19
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def count_existing_users(apps, schema_editor):
+    # Users have no join date, the existing accounts are all counted today
+    User = apps.get_model("users", "User")
+    UserSignupRollup = apps.get_model("users", "UserSignupRollup")
+    user_count = User.objects.count()
+    if user_count:
+        UserSignupRollup.objects.create(day=timezone.localdate(), count=user_count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0004_user_phone_number_alter_user_nickname"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserSignupRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField(unique=True)),
+                ("count", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_existing_users, migrations.RunPython.noop),
+    ]
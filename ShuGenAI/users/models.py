@@ -73,4 +73,10 @@ class Card(models.Model):
         return f"{self.card_type} ending in {self.card_number[-4:]}"
 
 
+class UserSignupRollup(models.Model):
+    # Accounts created per day minus the ones deleted that day; older accounts are counted on the day the table was created
+    day = models.DateField(unique=True)
+    count = models.IntegerField(default=0)
 
+    def __str__(self):
+        return f"{self.day}: {self.count}"
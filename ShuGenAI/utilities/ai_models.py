@@ -0,0 +1,119 @@
+"""Lazy loading of the AI models behind the image features.
+
+Nothing heavy is imported or loaded until a feature asks for a model: a worker that never serves
+remove_background or cut_out_object never loads their weights. Models listed in AI_MODELS_WARM_UP
+are loaded when the server process starts instead (see utilities/startup.py).
+"""
+import logging
+import os
+import sys
+import threading
+import time
+
+from django.utils.module_loading import import_string
+
+from utilities import metrics
+
+logger = logging.getLogger(__name__)
+
+# Loader of every model, a function without arguments returning the loaded model
+MODEL_LOADERS = {
+    "segmentation": "utilities.image_ai_utils.utils.load_segmentation_model",
+    "inpainting": "utilities.image_ai_utils.utils.load_inpainting_model",
+}
+
+
+class UnknownModel(Exception):
+    pass
+
+
+def _rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def _cuda_allocated():
+    # Only when the loader already imported torch, this must not be what imports it
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return 0
+    return torch.cuda.memory_allocated()
+
+
+class ModelManager:
+    """Load each model once per process, on first use, and keep what it cost."""
+
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self._models = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        # One lock per model, so that loading the inpainting pipeline does not hold up the segmentation
+        self._load_locks = {name: threading.Lock() for name in loaders}
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        if name not in self.loaders:
+            raise UnknownModel(f"Unknown model: {name}")
+        with self._load_locks[name]:
+            if name not in self._models:
+                self._load(name)
+        return self._models[name]
+
+    def _load(self, name):
+        # Resolving the loader imports torch and co, their own memory is not billed to the model
+        loader = import_string(self.loaders[name])
+        rss_before, cuda_before = _rss(), _cuda_allocated()
+        start = time.perf_counter()
+        model = loader()
+        load_seconds = time.perf_counter() - start
+        # Loads of other models may overlap, the resident memory is only an estimate then
+        stats = {
+            "load_seconds": round(load_seconds, 3),
+            "cpu_bytes": max(0, _rss() - rss_before),
+            "gpu_bytes": max(0, _cuda_allocated() - cuda_before),
+        }
+        with self._lock:
+            self._models[name] = model
+            self._stats[name] = stats
+        metrics.MODEL_LOADED.set(1, name)
+        metrics.MODEL_LOAD_DURATION.set(stats["load_seconds"], name)
+        metrics.MODEL_MEMORY.set(stats["cpu_bytes"], name, "cpu")
+        metrics.MODEL_MEMORY.set(stats["gpu_bytes"], name, "gpu")
+        logger.info("Loaded the %s model in %.1fs: %d MiB resident, %d MiB of CUDA memory",
+                    name, load_seconds, stats["cpu_bytes"] // 1024 ** 2, stats["gpu_bytes"] // 1024 ** 2)
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def warm_up(self, names):
+        for name in names:
+            self.get(name)
+
+    def report(self):
+        """Return ``{name: {"loaded": ..., "load_seconds": ..., "cpu_bytes": ..., "gpu_bytes": ...}}``."""
+        with self._lock:
+            return {name: {"loaded": name in self._models, **self._stats.get(name, {})} for name in self.loaders}
+
+
+models = ModelManager(MODEL_LOADERS)
+
+_image_ai_utils = None
+_image_ai_utils_lock = threading.Lock()
+
+
+def get_image_ai_utils():
+    """Return the process wide ImageAIUtils; creating it is cheap, its models load on first use."""
+    global _image_ai_utils
+    if _image_ai_utils is None:
+        with _image_ai_utils_lock:
+            if _image_ai_utils is None:
+                from utilities.image_ai_utils.utils import ImageAIUtils
+
+                _image_ai_utils = ImageAIUtils()
+    return _image_ai_utils
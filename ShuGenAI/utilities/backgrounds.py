@@ -0,0 +1,132 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+
+from utilities import metrics
+
+logger = logging.getLogger(__name__)
+
+# Stock backgrounds of edit_background, by the id the clients send
+BACKGROUND_FILES = {
+    1: "backgrounds/city.jpg",
+    2: "backgrounds/beach.jpg",
+    3: "backgrounds/desert.jpg",
+    4: "backgrounds/field.jpg",
+    5: "backgrounds/forest_autumn.jpg",
+    6: "backgrounds/forest.jpg",
+    7: "backgrounds/mountains.jpg",
+    8: "backgrounds/snow_mountains.jpg",
+    9: "backgrounds/office.jpg",
+    10: "backgrounds/underwater.jpg",
+}
+
+
+class BackgroundNotFound(Exception):
+    pass
+
+
+class BackgroundCache:
+    """LRU of decoded backgrounds and of their RGBA variants resized for a given output size.
+
+    Entries are keyed by ``(source, size)``, the source being a stock background id or the
+    SHA-256 of an uploaded one, and ``size`` None for the decoded original. The cache is bounded
+    by the bytes the decoded pixels take; the images it returns are shared and must not be modified.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        image_bytes = image_size_bytes(image)
+        if image_bytes > self.max_bytes:
+            return image
+        with self._lock:
+            if key in self._entries:
+                # Decoded by a concurrent request meanwhile, keep a single copy
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self._entries[key] = image
+            self.size_bytes += image_bytes
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= image_size_bytes(evicted)
+        return image
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+
+def image_size_bytes(image):
+    # Pillow keeps 3 channel images in 4 bytes per pixel as well
+    return image.width * image.height * (1 if image.mode in ("L", "P") else 4)
+
+
+cache = BackgroundCache(settings.BACKGROUND_CACHE_MAX_BYTES)
+
+
+def _decode(source, opener):
+    # Imported here, image_utils imports this module
+    from utilities.image_utils import decode_image
+
+    original = cache.get((source, None))
+    if original is None:
+        # Resampled to the size of the photo anyway, a background may always be decoded smaller
+        original = decode_image(opener(), max_dimension=settings.BACKGROUND_MAX_DIMENSION, allow_downscale=True)
+        original = cache.put((source, None), original)
+    return original
+
+
+def _stock_opener(background_id):
+    path = BACKGROUND_FILES.get(background_id) and finders.find(BACKGROUND_FILES[background_id])
+    if not path:
+        raise BackgroundNotFound(f"Background {background_id} is not available")
+    return lambda: path
+
+
+def stock_background(background_id, size):
+    """Return a stock background as RGBA at ``size``; raises BackgroundNotFound for unknown ids."""
+    return _resized(background_id, size, _stock_opener(background_id))
+
+
+def custom_background(uploaded, size):
+    """Return an uploaded background as RGBA at ``size``, decoded once however many times it is sent."""
+    content_hash = hashlib.sha256()
+    for chunk in uploaded.chunks():
+        content_hash.update(chunk)
+    uploaded.seek(0)
+    return _resized(content_hash.hexdigest(), size, lambda: uploaded)
+
+
+def _resized(source, size, opener):
+    background = cache.get((source, size))
+    if background is None:
+        original = _decode(source, opener)
+        with metrics.stage("background"):
+            background = original.resize(size).convert("RGBA")
+        background = cache.put((source, size), background)
+    return background
+
+
+def preload():
+    """Decode the stock backgrounds, so that the first requests do not pay for it."""
+    for background_id in BACKGROUND_FILES:
+        try:
+            _decode(background_id, _stock_opener(background_id))
+        except BackgroundNotFound as e:
+            logger.warning("%s, it can not be used with edit_background", e)
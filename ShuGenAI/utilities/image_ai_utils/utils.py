@@ -11,6 +11,8 @@ from ultralytics import YOLO
 from PIL import ImageFont, ImageDraw, Image, ImageFilter
 from diffusers import AutoPipelineForInpainting
 
+from utilities import ai_models, metrics
+
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 
 # Get the relative path of this file
@@ -51,6 +53,26 @@ color_codes = [
 ]
 
 
+def get_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def load_segmentation_model():
+    torch.cuda.empty_cache()
+    # Build a YOLOv9c model from pretrained weight
+    seg_model = YOLO(SEGMENT_MODEL_PATH)
+    seg_model.to(get_device())
+    return seg_model
+
+
+def load_inpainting_model():
+    torch.cuda.empty_cache()
+    # Load the inpainting model
+    inpaint_model = AutoPipelineForInpainting.from_pretrained(INPAINING_MODEL_NAME, max_memory={0: "3GiB", "cpu": "2GiB"}, torch_dtype=torch.float16)
+    inpaint_model.to(get_device())
+    return inpaint_model
+
+
 class ImageAIUtils:
     def __init__(self):
         with open(ENG_LABELS_PATH) as f:
@@ -58,17 +80,8 @@ class ImageAIUtils:
 
         with open(UKR_LABELS_PATH) as f:
             self.ukr_labels = json.load(f)
-        torch.cuda.empty_cache()
         # Determine the device to use
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-        # Build a YOLOv9c model from pretrained weight
-        self.seg_model = YOLO(SEGMENT_MODEL_PATH)
-        self.seg_model.to(self.device)
-
-        # Load the inpainting model
-        self.inpaint_model = AutoPipelineForInpainting.from_pretrained("runwayml/stable-diffusion-inpainting", max_memory={0: "3GiB", "cpu": "2GiB"}, torch_dtype=torch.float16)
-        self.inpaint_model.to(self.device)
+        self.device = get_device()
 
         # Load font
         self.labels_font = ImageFont.truetype(FONT_PATH, 14)
@@ -80,6 +93,15 @@ class ImageAIUtils:
             if c
         ]
 
+    # The models are loaded by the model manager the first time a feature needs them
+    @property
+    def seg_model(self):
+        return ai_models.models.get("segmentation")
+
+    @property
+    def inpaint_model(self):
+        return ai_models.models.get("inpainting")
+
     def _get_predictions_dict(self, results, lang="en"):
         local_results = results[0].cpu()
 
@@ -215,9 +237,11 @@ class ImageAIUtils:
     def infer_image(self, image: PIL.Image, language="en") -> (PIL.Image, []):
 
         # Get predictions for the image and overlay them on it
-        results = self.seg_model(image)
-        predictions = self._get_predictions_dict(results, language)
-        segmented_image = self._overlay_masks_on_image(image, predictions)
+        with metrics.stage("inference"):
+            results = self.seg_model(image)
+        with metrics.stage("postprocess"):
+            predictions = self._get_predictions_dict(results, language)
+            segmented_image = self._overlay_masks_on_image(image, predictions)
 
         # TODO: predictions need to be saved somewhere
 
@@ -274,8 +298,9 @@ class ImageAIUtils:
             predictions, main_object_idx, proximity_threshold=20
         )
 
-        # Resize the background image to match the dimensions of the image
-        background_image = background_image.resize(image.size)
+        # Resize the background image to match the dimensions of the image, unless it was cached at that size
+        if background_image.size != image.size:
+            background_image = background_image.resize(image.size)
 
         # Overlay the image on top of the resized background
         background_removed_image = image.convert("RGBA")
@@ -285,7 +310,8 @@ class ImageAIUtils:
         # Set the background pixels to transparent
         background_removed_image.putalpha(mask_image)
 
-        background_image = background_image.convert("RGBA")
+        if background_image.mode != "RGBA":
+            background_image = background_image.convert("RGBA")
         edited_image = Image.alpha_composite(background_image, background_removed_image)
 
         return edited_image
@@ -313,9 +339,10 @@ class ImageAIUtils:
         mask_image = Image.fromarray(padded_mask * 255).convert("RGB").resize((512, 512))
 
         prompt = "blends seamlessly with the surrounding area"
-        inpainted_image = self.inpaint_model(
-            prompt=prompt, image=image, mask_image=mask_image
-        ).images[0]
+        with metrics.stage("inference"):
+            inpainted_image = self.inpaint_model(
+                prompt=prompt, image=image, mask_image=mask_image
+            ).images[0]
 
         # Resize the inpainted image back to its original size
         inpainted_image = inpainted_image.resize(original_size)
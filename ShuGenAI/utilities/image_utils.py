@@ -1,359 +1,722 @@
 import base64
+import math
+from functools import partial
 
 import pillow_heif
 import rawpy
+from django.conf import settings
 from django.core.files.base import ContentFile
 from django.http import JsonResponse
 from PIL import Image, ImageDraw, ImageFilter
 from io import BytesIO
-from django.contrib.staticfiles import finders
 from rest_framework import status
-from features.models import History, Feature
-from features.serializers import HistorySerializer
-from django.apps import apps
-from django.core.files.storage import FileSystemStorage
+from features.storage import output_storage, sharded_name
+from features.utils import save_feature_history
 import pickle
 import numpy as np
+from utilities import ai_models, backgrounds, metrics
 
 
-BACKGROUNDS_DICT = {
-    1: finders.find('backgrounds/city.jpg'),
-    2: finders.find('backgrounds/beach.jpg'),
-    3: finders.find('backgrounds/desert.jpg'),
-    4: finders.find('backgrounds/field.jpg'),
-    5: finders.find('backgrounds/forest_autumn.jpg'),
-    6: finders.find('backgrounds/forest.jpg'),
-    7: finders.find('backgrounds/mountains.jpg'),
-    8: finders.find('backgrounds/snow_mountains.jpg'),
-    9: finders.find('backgrounds/office.jpg'),
-    10: finders.find('backgrounds/underwater.jpg')
-}
+def to_black_and_white(image, params):
+    return image.convert("L")
 
 
-def convert_image_to_bw(request, feature_key):
+def circle_mask(size):
+    # Create a mask to make the image round. Not cached: the sizes come from the uploads, and drawing
+    # the ellipse costs little next to the crop and the conversion
+    mask = Image.new("L", (size, size), 0)
+    draw = ImageDraw.Draw(mask)
+    draw.ellipse((0, 0, size, size), fill=255)
+    return mask
+
+
+def to_round(image, params):
+    # Crop first, so that only the square is converted rather than the whole image
+    size = min(image.size)  # Ensure the mask is square and covers the minimum dimension of the image
+    cropped_image = image.crop((0, 0, size, size)).convert("RGBA")
+    cropped_image.putalpha(circle_mask(size))
+    return cropped_image
+
+
+def to_pixelated(image, params, pixel_size=5):
+    # The output is a JPEG, transparency is dropped up front instead of carried through the resizes
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+    # reduce() averages every block of pixels in one pass, then each average is repeated over its block
+    return image.reduce(pixel_size).resize(image.size, Image.NEAREST)
+
+
+BLUR_MODES = ("exact", "fast")
+MAX_BLUR_RADIUS = 250
+# Radius the fast mode blurs the downscaled copy with, at least; smaller ones show the upsampling
+FAST_BLUR_MIN_RADIUS = 3
+
+
+def get_blur_options(params):
+    """Read the blur radius and mode of blur_image; raises ValueError on invalid ones."""
+    # Get blur intensity from request (default to 5 if not provided)
+    radius = float(params.get("blur_intensity", 5))
+    if not 0 <= radius <= MAX_BLUR_RADIUS:
+        raise ValueError(f"blur_intensity must be between 0 and {MAX_BLUR_RADIUS}")
+    blur_mode = params.get("blur_mode", "exact")
+    if blur_mode not in BLUR_MODES:
+        raise ValueError(f"Invalid blur_mode: {blur_mode}, expected one of {', '.join(BLUR_MODES)}")
+    return radius, blur_mode
+
+
+def fast_gaussian_blur(image, radius):
+    """Blur a copy reduced so the radius stays small, then upsample it back to the original size.
+
+    Pillow's Gaussian blur already runs separable box passes whose cost does not depend on the radius,
+    but it still touches every pixel three times per direction; here only 1/factor² of them are blurred.
+    """
+    factor = int(radius // FAST_BLUR_MIN_RADIUS)
+    if factor < 2:
+        return image.filter(ImageFilter.GaussianBlur(radius))
+    if image.mode not in ("L", "RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.mode or "transparency" in image.info else "RGB")
+    # The box reduction and the bilinear upsampling blur too, by a variance of factor²/12 and factor²/6
+    small_radius = math.sqrt(radius ** 2 - factor ** 2 / 4) / factor
+    small_image = image.reduce(factor).filter(ImageFilter.GaussianBlur(small_radius))
+    return small_image.resize(image.size, Image.BILINEAR)
+
+
+def to_blurred(image, params):
+    radius, blur_mode = get_blur_options(params)
+    if blur_mode == "fast":
+        return fast_gaussian_blur(image, radius)
+    # Apply Gaussian blur to the image
+    return image.filter(ImageFilter.GaussianBlur(radius))
+
+
+def to_rgb(image, params):
+    # Ensure image is in RGB mode for compatibility with JPEG format
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+
+def to_rgb_on_white(image, params):
+    if image.mode in ("RGBA", "LA"):
+        # Create a white background and paste the PNG onto it
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])  # Use alpha channel as mask
+        return background
+    return to_rgb(image, params)
+
+
+def keep_image(image, params):
+    return image
+
+
+def get_compression_quality(params):
+    # Get compression quality from request (default to 70 if not provided)
+    compression_quality = int(params.get("compression_quality", 70))
+    # Ensure the compression quality is between 1 and 100
+    return max(1, min(compression_quality, 100))
+
+
+# Output format of each file extension, JPEG for the other ones
+IMAGE_FORMATS = {".png": "PNG", ".webp": "WEBP", ".avif": "AVIF"}
+
+
+def encode_image(image, name, **save_options):
+    # The output format follows the file extension
+    image_format = next((image_format for extension, image_format in IMAGE_FORMATS.items()
+                         if name.endswith(extension)), "JPEG")
+    return ContentFile(encode_bytes(image, image_format, **save_options), name=name)
+
+
+def encode_bytes(image, image_format, **save_options):
+    if image_format == "JPEG" and image.mode not in ("L", "RGB", "CMYK"):
+        image = image.convert("RGB")
+    elif image_format in ("WEBP", "AVIF") and image.mode not in ("L", "RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.mode or "transparency" in image.info else "RGB")
+    buffer = BytesIO()
+    image.save(buffer, format=image_format, **save_options)
+    return buffer.getvalue()
+
+
+# Formats compress_image can output: Pillow format, file extension and whether progressive/optimize apply
+COMPRESSION_FORMATS = {
+    "jpeg": ("JPEG", "jpg", True),
+    "webp": ("WEBP", "webp", False),
+    "avif": ("AVIF", "avif", False),
+}
+# Highest quality tried when only a target size is given
+MAX_TARGET_QUALITY = 95
+
+
+def avif_available():
+    # AVIF is saved by pillow_heif, when its libheif was built with an AV1 encoder
+    try:
+        pillow_heif.register_avif_opener()
+    except Exception:
+        return False
+    return "AVIF" in Image.SAVE
+
+
+def get_compression_options(params):
+    """Read the compress_image parameters; raises ValueError on invalid ones."""
+    output_format = params.get("output_format", "jpeg").lower()
+    if output_format not in COMPRESSION_FORMATS:
+        raise ValueError(f"Invalid output_format: {output_format}, "
+                         f"expected one of {', '.join(COMPRESSION_FORMATS)}")
+    if output_format == "avif" and not avif_available():
+        raise ValueError("AVIF output is not available on this server")
+    target_size = params.get("target_size")
+    target_size = int(target_size) if target_size else None
+    if target_size is not None and target_size < 1:
+        raise ValueError("target_size must be a positive number of bytes")
+    min_quality = max(1, min(int(params.get("min_quality", 1)), 100))
+    if params.get("compression_quality"):
+        max_quality = get_compression_quality(params)
+    else:
+        # A target size alone searches the whole range, a fixed quality keeps the former default
+        max_quality = MAX_TARGET_QUALITY if target_size else get_compression_quality(params)
+    return {
+        "output_format": output_format,
+        "target_size": target_size,
+        "min_quality": min_quality,
+        "max_quality": max(min_quality, max_quality),
+        "progressive": str(params.get("progressive", "true")).lower() in ("1", "true", "yes"),
+        "optimize": str(params.get("optimize", "true")).lower() in ("1", "true", "yes"),
+    }
+
+
+def encode_compressed(image, options):
+    """Encode at the highest quality whose output fits the target size, never below the quality floor.
+
+    The trial encodes stay in memory and the quality range is bisected, so a target costs about
+    seven encodes. Returns the ContentFile and what was picked, ``target_met`` is False when even
+    the floor is larger than the target.
+    """
+    image_format, extension, jpeg_options = COMPRESSION_FORMATS[options["output_format"]]
+    save_options = {}
+    if jpeg_options:
+        save_options = {"progressive": options["progressive"], "optimize": options["optimize"]}
+
+    def encode(quality):
+        return encode_bytes(image, image_format, quality=quality, **save_options)
+
+    low, high = options["min_quality"], options["max_quality"]
+    quality, data = high, encode(high)
+    target_size = options["target_size"]
+    if target_size and len(data) > target_size:
+        # Invariant: ``high`` is too large, the best fitting encode found so far is kept in ``best``
+        best = None
+        while low < high:
+            middle = (low + high) // 2
+            trial = encode(middle)
+            if len(trial) <= target_size:
+                best = (middle, trial)
+                low = middle + 1
+            else:
+                high = middle
+        if best is None:
+            # Nothing in the range fits, the floor wins over the target
+            best = (options["min_quality"], encode(options["min_quality"]))
+        quality, data = best
+    info = {
+        "quality": quality,
+        "size": len(data),
+        "format": options["output_format"],
+        "target_met": target_size is None or len(data) <= target_size,
+    }
+    return ContentFile(data, name=f"compressed_image.{extension}"), info
+
+
+def get_max_dimension(params):
+    # Optional longest side of the output; smaller outputs let the decoder skip most of the pixels
+    max_dimension = params.get("max_dimension")
+    return max(1, int(max_dimension)) if max_dimension else None
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def too_large_response(error):
+    return JsonResponse({"error": str(error)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+
+def check_pixel_budget(width, height):
+    if width * height > settings.IMAGE_MAX_PIXELS:
+        raise ImageTooLarge(f"The image is {width}x{height} pixels, "
+                            f"at most {settings.IMAGE_MAX_PIXELS} pixels are supported")
+
+
+def fit_size(size, max_dimension):
+    width, height = size
+    scale = max_dimension / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+# Extra resolution decoded above the output size, so that the final resize still averages enough pixels
+DRAFT_REDUCING_GAP = 2.0
+
+
+# Bytes Pillow keeps per pixel for the usual modes (RGB is stored padded to 4 bytes)
+DECODED_BYTES_PER_PIXEL = 4
+
+
+def memory_budget_exceeded(width, height):
+    return ImageTooLarge(f"The image is {width}x{height} pixels, "
+                         f"too large to decode within {settings.IMAGE_MEMORY_BUDGET} bytes")
+
+
+def downscale_required(width, height):
+    # Nothing is decoded at full resolution piece by piece, the only way to process it is at a lower one
+    return ImageTooLarge(f"The image is {width}x{height} pixels, too large to decode at full resolution within "
+                         f"{settings.IMAGE_MEMORY_BUDGET} bytes; send allow_downscale=true to process it at a "
+                         f"lower resolution")
+
+
+def get_allow_downscale(params):
+    # Opt-in: the output is then smaller than the upload, and the response says so in downscaled_from
+    return str(params.get("allow_downscale", "false")).lower() in ("1", "true", "yes")
+
+
+def get_memory_reduce_factor(width, height, bytes_per_pixel=DECODED_BYTES_PER_PIXEL):
+    # Smallest integer downscale that fits the decoded image in the memory budget, 1 when it fits as is
+    decoded_bytes = width * height * bytes_per_pixel
+    if decoded_bytes <= settings.IMAGE_MEMORY_BUDGET:
+        return 1
+    return math.ceil(math.sqrt(decoded_bytes / settings.IMAGE_MEMORY_BUDGET))
+
+
+# Reductions the JPEG decoder can apply while decoding
+JPEG_DRAFT_SCALES = (1, 2, 4, 8)
+
+
+def get_jpeg_draft_scale(size, max_dimension, factor):
+    """Return the one JPEG draft scale that satisfies both the output size and the memory budget.
+
+    The output size allows the largest scale that still leaves DRAFT_REDUCING_GAP times its pixels,
+    the memory budget needs the smallest one that is at least ``factor``. Returns ``(scale, downscaled)``,
+    ``downscaled`` when the budget asked for more reduction than the output size; the scale is None
+    when no JPEG draft fits the budget.
+    """
+    scale = 1
+    if max_dimension is not None and max(size) > max_dimension:
+        width, height = fit_size(size, max_dimension)
+        needed = min(size[0] / (width * DRAFT_REDUCING_GAP), size[1] / (height * DRAFT_REDUCING_GAP))
+        scale = max(candidate for candidate in JPEG_DRAFT_SCALES if candidate <= max(1, needed))
+    if factor <= scale:
+        return scale, False
+    budget_scales = [candidate for candidate in JPEG_DRAFT_SCALES if candidate >= factor]
+    return (budget_scales[0] if budget_scales else None), True
+
+
+def decode_image(uploaded_image, open_image=Image.open, max_dimension=None, mode=None, allow_downscale=False):
+    """Decode an image within the pixel and memory budgets, at no more than the resolution the output needs.
+
+    ``mode`` lets JPEG decode straight to e.g. grayscale, ``max_dimension`` lets it decode
+    at 1/2, 1/4 or 1/8 of the size; both are ignored by the other formats. Images that do
+    not fit the memory budget at the resolution the output needs raise ImageTooLarge, unless
+    ``allow_downscale``: JPEG and uncompressed TIFF inputs are then decoded at a lower resolution,
+    the original size being kept in ``image.info["downscaled_from"]``. There is no tiled decoding
+    at full resolution.
+    """
+    with metrics.stage("decode"):
+        try:
+            image = open_image(uploaded_image)
+        except Image.DecompressionBombError as e:
+            raise ImageTooLarge(str(e))
+        # Only the header has been read so far, refuse before the pixels are allocated
+        check_pixel_budget(*image.size)
+        original_size = image.size
+        factor = get_memory_reduce_factor(*image.size)
+        downscaled = False
+        if image.format == "JPEG":
+            # A single draft: Pillow ignores the calls after the first one has configured the decoder
+            scale, downscaled = get_jpeg_draft_scale(image.size, max_dimension, factor)
+            if downscaled and not allow_downscale:
+                raise downscale_required(*image.size)
+            if scale is None:
+                raise memory_budget_exceeded(*image.size)
+            if scale > 1 or mode:
+                image.draft(mode, (image.width // scale, image.height // scale))
+        elif factor > 1:
+            if not allow_downscale:
+                raise downscale_required(*image.size)
+            if image.format != "TIFF":
+                raise memory_budget_exceeded(*image.size)
+            image = decode_tiff_strips(image, factor)
+            downscaled = True
+        # Pillow decodes lazily, load the pixels here so that the time is not billed to the next stage
+        image.load()
+        if max_dimension is not None and max(image.size) > max_dimension:
+            # Integer reduce first, then a regular resample over the last few times of the size
+            image.thumbnail((max_dimension, max_dimension), reducing_gap=DRAFT_REDUCING_GAP)
+        if downscaled:
+            image.info["downscaled_from"] = original_size
+    return image
+
+
+# Rows of raw pixel data read at once when a TIFF is decoded strip by strip
+TIFF_BAND_BYTES = 16 * 1024 * 1024
+
+
+def decode_tiff_strips(image, factor):
+    """Decode an uncompressed TIFF a band of rows at a time, reducing every band by ``factor``.
+
+    Only the reduced image and one band are held in memory. Compressed TIFFs are decoded by
+    libtiff in one go and can not be read this way.
+    """
+    tiles = image.tile
+    if image.mode not in ("L", "RGB", "RGBA", "CMYK") or not all(
+        decoder == "raw" and extents[0] == 0 and extents[2] == image.width and args[1:] == (0, 1)
+        for decoder, extents, _, args in tiles
+    ):
+        raise memory_budget_exceeded(*image.size)
+    rawmode = tiles[0][3][0]
+    bits_per_pixel = sum(image.tag_v2.get(258, (8,)))
+    row_bytes = (image.width * bits_per_pixel + 7) // 8
+    # Bands are a multiple of factor rows, so that each of them reduces to whole output rows
+    band_rows = factor * max(1, TIFF_BAND_BYTES // (row_bytes * factor))
+    output = Image.new(image.mode, (math.ceil(image.width / factor), math.ceil(image.height / factor)))
+    band, band_top = bytearray(), 0
+
+    def flush_band():
+        rows = len(band) // row_bytes
+        decoded = Image.frombytes(image.mode, (image.width, rows), bytes(band), "raw", rawmode)
+        output.paste(decoded.reduce(factor), (0, band_top // factor))
+
+    # Strips come in order; a band may span several of them
+    for _, (_, top, _, bottom), offset, _ in sorted(tiles, key=lambda tile: tile[1][1]):
+        image.fp.seek(offset)
+        remaining = bottom - top
+        while remaining:
+            rows = min(remaining, band_rows - len(band) // row_bytes)
+            band += image.fp.read(rows * row_bytes)
+            remaining -= rows
+            if len(band) // row_bytes == band_rows:
+                flush_band()
+                band_top += band_rows
+                band.clear()
+    if band:
+        flush_band()
+    return output
+
+
+# Encodings of the outputs that can be transparent: lossless PNG, lossless WebP, and lossy WebP
+# whose alpha channel stays lossless, for edges that must not bleed
+TRANSPARENT_ENCODINGS = {"png": ".png", "webp_lossless": ".webp", "webp": ".webp"}
+# Effort of the lossless encoders, from 0 (fastest) to 9 (smallest); 6 is the zlib default
+DEFAULT_COMPRESSION_LEVEL = 6
+TRANSPARENT_WEBP_QUALITY = 90
+
+
+def get_transparent_options(params):
+    """Read the output encoding of the transparent outputs; raises ValueError on invalid ones."""
+    encoding = params.get("output_encoding", "png")
+    if encoding not in TRANSPARENT_ENCODINGS:
+        raise ValueError(f"Invalid output_encoding: {encoding}, "
+                         f"expected one of {', '.join(TRANSPARENT_ENCODINGS)}")
+    compression_level = int(params.get("compression_level", DEFAULT_COMPRESSION_LEVEL))
+    if not 0 <= compression_level <= 9:
+        raise ValueError("compression_level must be between 0 and 9")
+    return {"encoding": encoding, "compression_level": compression_level}
+
+
+def to_exact_palette(image):
+    """Return the image as a palette image with the same pixels, or None when it has more than 256 colors."""
+    # getcolors() gives up as soon as it sees one color too many, photos bail out early
+    colors = image.getcolors(256)
+    if colors is None:
+        return None
+    rgba = np.asarray(image.convert("RGBA") if image.mode != "RGBA" else image)
+    pixels = rgba.view(np.uint32)[:, :, 0]
+    # RGB colors come as 3-tuples, they are opaque
+    palette = np.array([color + (255,) * (4 - len(color)) for _, color in colors], np.uint8)
+    palette = np.sort(palette.view(np.uint32)[:, 0])
+    palette_image = Image.fromarray(np.searchsorted(palette, pixels).astype(np.uint8), "P")
+    palette = palette.view(np.uint8).reshape(-1, 4)
+    if image.mode == "RGB":
+        # Without alpha in the palette, no transparency chunk is written
+        palette_image.putpalette(palette[:, :3].tobytes(), rawmode="RGB")
+    else:
+        palette_image.putpalette(palette.tobytes(), rawmode="RGBA")
+    return palette_image
+
+
+def encode_transparent(image, name, options=None):
+    """Encode an output that may be transparent as PNG or WebP, whichever ``options`` asks for.
+
+    The alpha channel is dropped when every pixel is opaque, and PNGs with at most 256 colors,
+    like masks and flat graphics, are written with a palette; both are lossless.
+    """
+    options = options or {"encoding": "png", "compression_level": DEFAULT_COMPRESSION_LEVEL}
+    encoding, compression_level = options["encoding"], options["compression_level"]
+    if image.mode in ("RGBA", "LA") and image.getextrema()[-1] == (255, 255):
+        image = image.convert(image.mode[:-1])
+    name = name.rsplit(".", 1)[0] + TRANSPARENT_ENCODINGS[encoding]
+    if encoding == "png":
+        if image.mode in ("RGB", "RGBA"):
+            image = to_exact_palette(image) or image
+        return encode_image(image, name, compress_level=compression_level)
+    # WebP spends its effort through method and, when lossless, quality. Methods 5 and 6 are left out,
+    # they took several times as long for about 1% smaller files on photos
+    save_options = {"method": round(compression_level * 4 / 9)}
+    if encoding == "webp_lossless":
+        save_options.update(lossless=True, quality=round(compression_level * 100 / 9))
+    else:
+        save_options.update(quality=TRANSPARENT_WEBP_QUALITY, alpha_quality=100)
+    return encode_image(image, name, **save_options)
+
+
+def save_png(image, name, options=None):
+    with metrics.stage("encode"):
+        return encode_transparent(image, name, options)
+
+
+# Bytes LibRaw needs per output pixel while demosaicing: its 4 x 16 bit working image,
+# the 8 bit RGB array it returns and the Pillow copy made from it
+RAW_BYTES_PER_PIXEL = 8 + 3 + DECODED_BYTES_PER_PIXEL
+
+
+# preview: the JPEG the camera embedded in the file, fast: half size without demosaicing,
+# full: full size demosaic
+RAW_QUALITIES = ("preview", "fast", "full")
+
+
+def get_raw_quality(params):
+    raw_quality = params.get("raw_quality", "full")
+    if raw_quality not in RAW_QUALITIES:
+        raise ValueError(f"raw_quality must be one of: {', '.join(RAW_QUALITIES)}")
+    return raw_quality
+
+
+def extract_raw_thumbnail(raw):
+    try:
+        thumbnail = raw.extract_thumb()
+    except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+        return None
+    if thumbnail.format == rawpy.ThumbFormat.JPEG:
+        # Left for decode_image to decode, it can draft it like any other JPEG
+        return Image.open(BytesIO(thumbnail.data))
+    return Image.fromarray(thumbnail.data)
+
+
+def open_raw_image(uploaded_image, raw_quality="full", allow_downscale=False):
+    # Use rawpy to read the RAW image
+    with rawpy.imread(uploaded_image) as raw:
+        if raw_quality == "preview":
+            thumbnail = extract_raw_thumbnail(raw)
+            if thumbnail is not None:
+                return thumbnail
+            # No usable embedded preview, the fast mode is the next best thing
+        width, height = raw.sizes.width, raw.sizes.height
+        check_pixel_budget(width, height)
+        half_size = raw_quality != "full"
+        # A full demosaic that does not fit the memory budget is only done at half the size on request
+        downscaled = not half_size and get_memory_reduce_factor(width, height, RAW_BYTES_PER_PIXEL) > 1
+        if downscaled:
+            if not allow_downscale:
+                raise downscale_required(width, height)
+            half_size = True
+        if half_size and get_memory_reduce_factor(width // 2, height // 2, RAW_BYTES_PER_PIXEL) > 1:
+            raise memory_budget_exceeded(width, height)
+        rgb_image = raw.postprocess(half_size=half_size)
+    # Convert the numpy array (RGB image) to a Pillow Image
+    image = Image.fromarray(rgb_image)
+    if downscaled:
+        image.info["downscaled_from"] = (width, height)
+    return image
+
+
+def process_image(request, feature_key, transform, name, open_image=Image.open, draft_mode=None, encode=encode_image,
+                  **save_options):
     if request.method == "POST" and request.FILES.get("file"):
-        uploaded_image = request.FILES["file"]
-        # Open the image and convert it to black and white
-        image = Image.open(uploaded_image)
-        bw_image = image.convert("L")
-        # Save the black and white image to a BytesIO buffer
-        buffer = BytesIO()
-        bw_image.save(buffer, format="JPEG")
-        buffer.seek(0)
-        # Create a ContentFile for saving to the FileField
-        image_file = ContentFile(buffer.getvalue(), name="bw_image.jpg")
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None # Feature ID should be provided in the request
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
-        # Return the serialized data
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
+        image = decode_image(request.FILES["file"], open_image, get_max_dimension(request.POST), draft_mode,
+                             get_allow_downscale(request.POST))
+        # Tell the client when the memory budget made us work on a smaller image than it sent
+        downscaled_from = image.info.get("downscaled_from")
+        with metrics.stage("transform"):
+            image = transform(image, request.POST)
+        with metrics.stage("encode"):
+            image_file = encode(image, name, **save_options)
+        return save_feature_history(request, feature_key, image_file,
+                                    extra_data={"downscaled_from": downscaled_from} if downscaled_from else None)
     return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
 
 
+# Feature steps that can be chained on one in-memory image: transform and output file name
+IMAGE_PIPELINE_STEPS = {
+    "black_and_white": (to_black_and_white, "bw_image.jpg"),
+    "round_image": (to_round, "round_image.png"),
+    "pixelate_image": (to_pixelated, "pixelated_image.jpg"),
+    "blur_image": (to_blurred, "blurred_image.jpg"),
+    "compress_image": (keep_image, "compressed_image.jpg"),
+    "heif_to_jpg": (keep_image, "heic_image.jpg"),
+    "png_to_jpg": (to_rgb_on_white, "png_image.jpg"),
+    "raw_to_jpg": (keep_image, "raw_image.jpg"),
+    "tiff_to_jpg": (to_rgb, "tiff_image.jpg"),
+}
+
+# Steps that are about the format of the upload; later in a chain the image is decoded already
+FIRST_IMAGE_PIPELINE_STEPS = ("heif_to_jpg", "raw_to_jpg", "tiff_to_jpg")
+
+
+def validate_image_pipeline(steps):
+    for step in steps[1:]:
+        if step in FIRST_IMAGE_PIPELINE_STEPS:
+            raise ValueError(f"{step} converts the uploaded file, it can only be the first step")
+
+
+# Mode the decoder can produce directly when a feature comes first, saving a conversion of the full image
+IMAGE_DRAFT_MODES = {
+    "black_and_white": "L",
+}
+
+
+def run_image_pipeline(uploaded_image, steps, params):
+    """Decode once, apply every step's transform and encode only the last step's output."""
+    pillow_heif.register_heif_opener()
+    open_image = Image.open
+    if steps[0] == "raw_to_jpg":
+        open_image = partial(open_raw_image, raw_quality=get_raw_quality(params),
+                             allow_downscale=get_allow_downscale(params))
+    image = decode_image(uploaded_image, open_image, get_max_dimension(params), IMAGE_DRAFT_MODES.get(steps[0]),
+                         get_allow_downscale(params))
+    with metrics.stage("transform"):
+        for feature_key in steps:
+            transform, _ = IMAGE_PIPELINE_STEPS[feature_key]
+            image = transform(image, params)
+    _, name = IMAGE_PIPELINE_STEPS[steps[-1]]
+    with metrics.stage("encode"):
+        if steps[-1] == "compress_image":
+            image_file, _ = encode_compressed(image, get_compression_options(params))
+            return image_file
+        if name.endswith(".png"):
+            return encode_transparent(image, name, get_transparent_options(params))
+        return encode_image(image, name)
+
+
+def convert_image_to_bw(request, feature_key):
+    return process_image(request, feature_key, to_black_and_white, "bw_image.jpg",
+                         draft_mode=IMAGE_DRAFT_MODES["black_and_white"])
+
+
 def convert_image_to_round(request, feature_key):
-    if request.method == "POST" and request.FILES.get("file"):
-        uploaded_image = request.FILES["file"]
-        # Open the image and ensure it's in RGBA mode (supports transparency)
-        image = Image.open(uploaded_image).convert("RGBA")
-        # Create a mask to make the image round
-        size = min(image.size)  # Ensure the mask is square and covers the minimum dimension of the image
-        mask = Image.new("L", (size, size), 0)
-        draw = ImageDraw.Draw(mask)
-        draw.ellipse((0, 0, size, size), fill=255)
-        # Crop and apply the mask to the image
-        cropped_image = image.crop((0, 0, size, size))
-        cropped_image.putalpha(mask)
-        # Save the round image to a BytesIO buffer as a PNG (supports transparency)
-        buffer = BytesIO()
-        cropped_image.save(buffer, format="PNG")
-        buffer.seek(0)
-        # Create a ContentFile for saving to the FileField
-        image_file = ContentFile(buffer.getvalue(), name="round_image.png")
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
-        # Return the serialized data
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
-    return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
-def convert_image_to_pixelated(request, feature_key, pixel_size=5):
-    if request.method == "POST" and request.FILES.get("file"):
-        uploaded_image = request.FILES["file"]
-        # Open the image
-        image = Image.open(uploaded_image).convert("RGBA")
-        # Pixelate the image
-        width, height = image.size
-        small_image = image.resize(
-            (width // pixel_size, height // pixel_size),
-            resample=Image.BILINEAR
-        )
-        pixelated_image = small_image.resize((width, height), Image.NEAREST).convert("RGB")
-        # Save the pixelated image to a BytesIO buffer
-        buffer = BytesIO()
-        pixelated_image.save(buffer, format="JPEG")
-        buffer.seek(0)
-        # Create a ContentFile for saving to the FileField
-        image_file = ContentFile(buffer.getvalue(), name="pixelated_image.jpg")
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
-        # Return the serialized data
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
-    return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        options = get_transparent_options(request.POST)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    # PNG or WebP output keeps the transparent corners
+    return process_image(request, feature_key, to_round, "round_image.png", encode=encode_transparent, options=options)
+
+
+def convert_image_to_pixelated(request, feature_key):
+    return process_image(request, feature_key, to_pixelated, "pixelated_image.jpg")
+
 
 def convert_image_to_blurred(request, feature_key):
-    if request.method == "POST" and request.FILES.get("file"):
-        # Get blur intensity from request (default to 5 if not provided)
-        blur_intensity = int(request.POST.get("blur_intensity", 5))
-        uploaded_image = request.FILES["file"]
-        # Open the image
-        image = Image.open(uploaded_image)
-        # Apply Gaussian blur to the image
-        blurred_image = image.filter(ImageFilter.GaussianBlur(blur_intensity))
-        # Save the blurred image to a BytesIO buffer
-        buffer = BytesIO()
-        blurred_image.save(buffer, format="JPEG")
-        buffer.seek(0)
-        # Create a ContentFile for saving to the FileField
-        image_file = ContentFile(buffer.getvalue(), name="blurred_image.jpg")
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
-        # Return the serialized data
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
-    return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        get_blur_options(request.POST)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return process_image(request, feature_key, to_blurred, "blurred_image.jpg")
+
 
 def compress_image(request, feature_key):
     if request.method == "POST" and request.FILES.get("file"):
-        # Get compression quality from request (default to 70 if not provided)
-        compression_quality = int(request.POST.get("compression_quality", 70))
-        # Ensure the compression quality is between 1 and 100
-        compression_quality = max(1, min(compression_quality, 100))
-        uploaded_image = request.FILES["file"]
-        # Open the image
-        image = Image.open(uploaded_image)
-        # Save the image to a BytesIO buffer with the specified quality
-        buffer = BytesIO()
-        if image.mode in ("RGBA", "LA"):
-            image = image.convert("RGB")
-        image.save(buffer, format="JPEG", quality=compression_quality)
-        buffer.seek(0)
-        # Create a ContentFile for saving to the FileField
-        image_file = ContentFile(buffer.getvalue(), name="compressed_image.jpg")
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
-        # Return the serialized data
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
+        try:
+            options = get_compression_options(request.POST)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        image = decode_image(request.FILES["file"], Image.open, get_max_dimension(request.POST),
+                             allow_downscale=get_allow_downscale(request.POST))
+        with metrics.stage("encode"):
+            image_file, extra_data = encode_compressed(image, options)
+        downscaled_from = image.info.get("downscaled_from")
+        if downscaled_from:
+            extra_data["downscaled_from"] = downscaled_from
+        return save_feature_history(request, feature_key, image_file, extra_data=extra_data)
     return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
 
 
 def convert_heic_to_jpg(request, feature_key):
     pillow_heif.register_heif_opener()
-    if request.method == "POST" and request.FILES.get("file"):
-        uploaded_image = request.FILES["file"]
-        # Open the HEIC image
-        image = Image.open(uploaded_image)
-        # Ensure image is loaded in RGB mode for compatibility with JPEG format
-        if image.mode in ("RGBA", "LA"):
-            image = image.convert("RGB")
-        # Save the image as JPG to a BytesIO buffer
-        buffer = BytesIO()
-        image.save(buffer, format="JPEG")
-        buffer.seek(0)
-        # Create a ContentFile for saving to the FileField
-        image_file = ContentFile(buffer.getvalue(), name="heic_image.jpg")
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
-        # Return the serialized data
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
-    return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
+    return process_image(request, feature_key, keep_image, "heic_image.jpg")
 
 
 def convert_png_to_jpg(request, feature_key):
-    if request.method == "POST" and request.FILES.get("file"):
-        uploaded_image = request.FILES["file"]
-        # Open the PNG image
-        image = Image.open(uploaded_image)
-        # Ensure image is loaded in RGB mode for compatibility with JPEG format
-        if image.mode in ("RGBA", "LA"):
-            # Create a white background and paste the PNG onto it
-            background = Image.new("RGB", image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[3])  # Use alpha channel as mask
-            image = background
-        elif image.mode != "RGB":
-            image = image.convert("RGB")
-        # Save the image as JPG to a BytesIO buffer
-        buffer = BytesIO()
-        image.save(buffer, format="JPEG")
-        buffer.seek(0)
-        # Create a ContentFile for saving to the FileField
-        image_file = ContentFile(buffer.getvalue(), name="png_image.jpg")
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
-        # Return the serialized data
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
-    return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
+    return process_image(request, feature_key, to_rgb_on_white, "png_image.jpg")
+
 
 def convert_raw_to_jpg(request, feature_key):
-    if request.method == "POST" and request.FILES.get("file"):
-        uploaded_image = request.FILES["file"]
-        # Use rawpy to read the RAW image
-        with rawpy.imread(uploaded_image) as raw:
-            rgb_image = raw.postprocess()
-        # Convert the numpy array (RGB image) to a Pillow Image
-        image = Image.fromarray(rgb_image)
-        # Save the image as JPG to a BytesIO buffer
-        buffer = BytesIO()
-        image.save(buffer, format="JPEG")
-        buffer.seek(0)
-        # Create a ContentFile for saving to the FileField
-        image_file = ContentFile(buffer.getvalue(), name="raw_image.jpg")
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
-        # Return the serialized data
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
-    return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        raw_quality = get_raw_quality(request.POST)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return process_image(request, feature_key, keep_image, "raw_image.jpg",
+                         open_image=partial(open_raw_image, raw_quality=raw_quality,
+                                            allow_downscale=get_allow_downscale(request.POST)))
+
 
 def convert_tiff_to_jpg(request, feature_key):
-    if request.method == "POST" and request.FILES.get("file"):
-        uploaded_image = request.FILES["file"]
-        # Open the TIFF image
-        image = Image.open(uploaded_image)
-        # Ensure image is in RGB mode for compatibility with JPEG format
-        if image.mode != "RGB":
-            image = image.convert("RGB")
-        # Save the image as JPG to a BytesIO buffer
-        buffer = BytesIO()
-        image.save(buffer, format="JPEG")
-        buffer.seek(0)
-        # Create a ContentFile for saving to the FileField
-        image_file = ContentFile(buffer.getvalue(), name="tiff_image.jpg")
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
-        # Return the serialized data
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
-    return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
+    return process_image(request, feature_key, to_rgb, "tiff_image.jpg")
 
 
 def remove_background(request, feature_key):
-    image_ai_utils = apps.get_app_config('utilities').image_ai_utils_instance
+    image_ai_utils = ai_models.get_image_ai_utils()
+    try:
+        options = get_transparent_options(request.POST)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     if request.method == "POST" and request.FILES.get("file"):
         uploaded_image = request.FILES["file"]
-        input_image = Image.open(uploaded_image)
+        input_image = decode_image(uploaded_image, allow_downscale=get_allow_downscale(request.POST))
         _, predictions = image_ai_utils.infer_image(input_image)
-        image = image_ai_utils.remove_background(input_image, predictions)
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        buffer.seek(0)
+        with metrics.stage("composite"):
+            image = image_ai_utils.remove_background(input_image, predictions)
         # Create a ContentFile for saving to the FileField
-        image_file = ContentFile(buffer.getvalue(), name="remove_background.png")
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
-        # Return the serialized data
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
+        image_file = save_png(image, "remove_background.png", options)
+        return save_feature_history(request, feature_key, image_file)
     return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
 
 def edit_background(request, feature_key):
-    image_ai_utils = apps.get_app_config('utilities').image_ai_utils_instance
-    if request.method == "POST" and request.FILES.get("file") and request.POST.get("background"):
+    image_ai_utils = ai_models.get_image_ai_utils()
+    try:
+        options = get_transparent_options(request.POST)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    custom_background = request.FILES.get("background_file")
+    if request.method == "POST" and request.FILES.get("file") and (request.POST.get("background") or custom_background):
         uploaded_image = request.FILES["file"]
-        background_image = BACKGROUNDS_DICT[int(request.POST["background"])]
-        input_image = Image.open(uploaded_image)
-        input_background = Image.open(background_image)
+        # A smaller output lets the composite work on a smaller, cached variant of the background
+        input_image = decode_image(uploaded_image, max_dimension=get_max_dimension(request.POST),
+                                   allow_downscale=get_allow_downscale(request.POST))
+        try:
+            if custom_background:
+                input_background = backgrounds.custom_background(custom_background, input_image.size)
+            else:
+                input_background = backgrounds.stock_background(int(request.POST["background"]), input_image.size)
+        except (ValueError, backgrounds.BackgroundNotFound) as e:
+            return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         _, predictions = image_ai_utils.infer_image(input_image)
-        image = image_ai_utils.edit_background(input_image, input_background, predictions)
+        with metrics.stage("composite"):
+            image = image_ai_utils.edit_background(input_image, input_background, predictions)
 
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        buffer.seek(0)
         # Create a ContentFile for saving to the FileField
-        image_file = ContentFile(buffer.getvalue(), name="edited_background.png")
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
-        # Return the serialized data
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
+        image_file = save_png(image, "edited_background.png", options)
+        return save_feature_history(request, feature_key, image_file)
     return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
 
 
 def pick_up_object(request, feature_key):
-    image_ai_utils = apps.get_app_config('utilities').image_ai_utils_instance
+    image_ai_utils = ai_models.get_image_ai_utils()
+    try:
+        options = get_transparent_options(request.POST)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
     if request.method == "POST" and request.FILES.get("file") and not request.POST.get('objects'):
         uploaded_image = request.FILES["file"]
-        input_image = Image.open(uploaded_image)
+        input_image = decode_image(uploaded_image, allow_downscale=get_allow_downscale(request.POST))
         language = request.POST.get('language', "en")
         # Get predictions and segmented image
         segmented_image, predictions = image_ai_utils.infer_image(input_image, language)
@@ -368,20 +731,18 @@ def pick_up_object(request, feature_key):
         request.session['predictions'] = encoded_predictions
 
         # Save the segmented image to the file system
-        buffer = BytesIO()
-        segmented_image.save(buffer, format="PNG")
-        buffer.seek(0)
-        fs = FileSystemStorage()
-        image_path = fs.save('segmented_images/segmented_image.png', ContentFile(buffer.getvalue()))
+        segmented_file = save_png(segmented_image, "segmented_image.png")
+        with metrics.stage("storage"):
+            image_path = output_storage.save(sharded_name('segmented_images', 'segmented_image.png'), segmented_file)
 
         return JsonResponse({
-            'segmented_image_url': request.build_absolute_uri(fs.url(image_path)),
+            'segmented_image_url': request.build_absolute_uri(output_storage.url(image_path)),
             'objects': list(predictions.keys())
         })
 
     elif request.method == "POST" and request.FILES.get("file") and request.POST.get('objects'):
         uploaded_image = request.FILES["file"]
-        input_image = Image.open(uploaded_image)
+        input_image = decode_image(uploaded_image, allow_downscale=get_allow_downscale(request.POST))
         objects_str = request.POST.get('objects')
 
         if ',' in objects_str:
@@ -400,37 +761,25 @@ def pick_up_object(request, feature_key):
             predictions = pickle.loads(serialized_predictions)
 
         # Process image with the picked-up objects
-        image = image_ai_utils.pick_up_object(input_image, objects_list, predictions)
-
-        # Convert image to buffer for saving
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        buffer.seek(0)
+        with metrics.stage("composite"):
+            image = image_ai_utils.pick_up_object(input_image, objects_list, predictions)
 
         # Create a ContentFile for saving the image
-        image_file = ContentFile(buffer.getvalue(), name="picked.png")
-
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
+        image_file = save_png(image, "picked.png", options)
 
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
+        return save_feature_history(request, feature_key, image_file)
 
     return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
 
 def cut_out_object(request, feature_key):
-    image_ai_utils = apps.get_app_config('utilities').image_ai_utils_instance
+    image_ai_utils = ai_models.get_image_ai_utils()
+    try:
+        options = get_transparent_options(request.POST)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     if request.method == "POST" and request.FILES.get("file") and not request.POST.get('objects'):
         uploaded_image = request.FILES["file"]
-        input_image = Image.open(uploaded_image)
+        input_image = decode_image(uploaded_image, allow_downscale=get_allow_downscale(request.POST))
         language = request.POST.get('language', "en")
         # Get predictions and segmented image
         segmented_image, predictions = image_ai_utils.infer_image(input_image, language)
@@ -444,19 +793,17 @@ def cut_out_object(request, feature_key):
         request.session['predictions'] = encoded_predictions
 
         # Save the segmented image to the file system
-        buffer = BytesIO()
-        segmented_image.save(buffer, format="PNG")
-        buffer.seek(0)
-        fs = FileSystemStorage()
-        image_path = fs.save('segmented_images/segmented_image.png', ContentFile(buffer.getvalue()))
+        segmented_file = save_png(segmented_image, "segmented_image.png")
+        with metrics.stage("storage"):
+            image_path = output_storage.save(sharded_name('segmented_images', 'segmented_image.png'), segmented_file)
 
         return JsonResponse({
-            'segmented_image_url': request.build_absolute_uri(fs.url(image_path)),
+            'segmented_image_url': request.build_absolute_uri(output_storage.url(image_path)),
             'objects': list(predictions.keys())
         })
     if request.method == "POST" and request.FILES.get("file") and request.POST.get('objects'):
         uploaded_image = request.FILES["file"]
-        input_image = Image.open(uploaded_image)
+        input_image = decode_image(uploaded_image, allow_downscale=get_allow_downscale(request.POST))
         objects_str = request.POST.get('objects')
         if ',' in objects_str:
             objects_list = objects_str.split(',')
@@ -474,20 +821,7 @@ def cut_out_object(request, feature_key):
 
         image = image_ai_utils.cut_out_object(input_image, objects_list, predictions)
 
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        buffer.seek(0)
         # Create a ContentFile for saving to the FileField
-        image_file = ContentFile(buffer.getvalue(), name="cut.png")
-        # Get the user and feature, assuming the user is authenticated
-        user = request.user if request.user.is_authenticated else None
-        feature = Feature.objects.get(key=feature_key)
-        feature.used_count += 1
-        feature.save()
-        # Create and save the History instance
-        history = History.objects.create(user=user, file=image_file, feature=feature)
-        # Serialize the History instance
-        serializer = HistorySerializer(history, context={'request': request})
-        # Return the serialized data
-        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
+        image_file = save_png(image, "cut.png", options)
+        return save_feature_history(request, feature_key, image_file)
     return JsonResponse({"error": "Invalid request or no image provided"}, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
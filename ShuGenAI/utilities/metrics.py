@@ -0,0 +1,156 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Upper bounds of the histogram buckets, in seconds and in bytes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2, 1024 ** 3)
+
+# Key of the feature whose request is being processed in the current thread or task
+_current_feature = ContextVar("current_feature", default=None)
+
+
+class Histogram:
+    """Cumulative histogram with labels, kept in the memory of the current process."""
+
+    def __init__(self, name, help_text, buckets, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # One counter per bucket plus +Inf, then the sum of the observed values
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        for label_values, counts, total in series:
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{upper_bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Last value of a measurement with labels, kept in the memory of the current process."""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._series[label_values] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for label_values, value in series:
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+            lines.append(f"{self.name}{{{labels}}} {value}")
+        return lines
+
+
+FEATURE_DURATION = Histogram("shugenai_feature_duration_seconds",
+                             "Total time spent serving a feature request.",
+                             LATENCY_BUCKETS, ("feature", "status"))
+STAGE_DURATION = Histogram("shugenai_feature_stage_duration_seconds",
+                           "Time spent in each stage of a feature request.",
+                           LATENCY_BUCKETS, ("feature", "stage"))
+INPUT_SIZE = Histogram("shugenai_feature_input_bytes",
+                       "Size of the uploaded file or text of a feature request.",
+                       SIZE_BUCKETS, ("feature",))
+OUTPUT_SIZE = Histogram("shugenai_feature_output_bytes",
+                        "Size of the file stored as the result of a feature request.",
+                        SIZE_BUCKETS, ("feature",))
+MODEL_LOADED = Gauge("shugenai_model_loaded",
+                     "Whether an AI model is loaded in this process.",
+                     ("model",))
+MODEL_LOAD_DURATION = Gauge("shugenai_model_load_duration_seconds",
+                            "Time the last load of an AI model took.",
+                            ("model",))
+MODEL_MEMORY = Gauge("shugenai_model_memory_bytes",
+                     "Memory an AI model took when it was loaded, resident memory for the cpu and "
+                     "allocated CUDA memory for the gpu.",
+                     ("model", "device"))
+
+REGISTRY = (FEATURE_DURATION, STAGE_DURATION, INPUT_SIZE, OUTPUT_SIZE,
+            MODEL_LOADED, MODEL_LOAD_DURATION, MODEL_MEMORY)
+
+
+class FeatureSpan:
+    def __init__(self, feature_key):
+        self.feature_key = feature_key
+        # Set by the caller once the response is known
+        self.status = "error"
+
+
+def get_input_size(request):
+    uploaded = request.FILES.get("file")
+    if uploaded is not None:
+        return uploaded.size
+    return len(request.POST.get("text", "").encode("utf-8"))
+
+
+@contextmanager
+def feature_span(feature_key, input_size=None):
+    """Time a whole feature request; stages recorded inside it are attributed to ``feature_key``."""
+    span = FeatureSpan(feature_key)
+    token = _current_feature.set(feature_key)
+    if input_size is not None:
+        INPUT_SIZE.observe(input_size, feature_key)
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        FEATURE_DURATION.observe(time.perf_counter() - start, feature_key, str(span.status))
+        _current_feature.reset(token)
+
+
+def observe_stage(name, seconds):
+    feature_key = _current_feature.get()
+    if feature_key is not None:
+        STAGE_DURATION.observe(seconds, feature_key, name)
+
+
+@contextmanager
+def stage(name):
+    """Time one stage (decode, inference, encode, storage...) of the current feature request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def observe_output_size(size):
+    feature_key = _current_feature.get()
+    if feature_key is not None:
+        OUTPUT_SIZE.observe(size, feature_key)
+
+
+def render():
+    lines = []
+    for histogram in REGISTRY:
+        lines.extend(histogram.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,10 @@
+from django.conf import settings
+
+from utilities import ai_models, backgrounds
+
+
+def warm_up():
+    """Load what the first requests would otherwise wait for; called by the ASGI and WSGI entry points."""
+    if settings.BACKGROUND_PRELOAD:
+        backgrounds.preload()
+    ai_models.models.warm_up(settings.AI_MODELS_WARM_UP)
@@ -1,3 +1,125 @@
-from django.test import TestCase
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+import numpy as np
+from PIL import Image
+
+from utilities import image_utils
+
+
+def jpeg_bytes(size=(400, 300), color=(200, 10, 10)):
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="JPEG")
+    return BytesIO(buffer.getvalue())
+
+
+# Half the bytes the 400x300 test image takes decoded, it fits once reduced by 2
+@override_settings(IMAGE_MEMORY_BUDGET=400 * 300 * 4 // 2)
+class DecodeImageTests(SimpleTestCase):
+    def test_over_budget_images_are_refused_by_default(self):
+        with self.assertRaisesMessage(image_utils.ImageTooLarge, "allow_downscale=true"):
+            image_utils.decode_image(jpeg_bytes())
+
+    def test_downscale_on_request(self):
+        image = image_utils.decode_image(jpeg_bytes(), allow_downscale=True)
+        self.assertEqual(image.size, (200, 150))
+        self.assertEqual(image.info["downscaled_from"], (400, 300))
+
+    def test_smaller_output_is_not_a_downscale(self):
+        image = image_utils.decode_image(jpeg_bytes(), max_dimension=100)
+        self.assertEqual(image.size, (100, 75))
+        self.assertNotIn("downscaled_from", image.info)
+
+    def test_one_draft_scale_for_budget_and_output_size(self):
+        self.assertEqual(image_utils.get_jpeg_draft_scale((400, 300), 150, 2), (2, True))
+        self.assertEqual(image_utils.get_jpeg_draft_scale((400, 300), 100, 2), (2, False))
+        self.assertEqual(image_utils.get_jpeg_draft_scale((4000, 3000), 100, 2), (8, False))
+        self.assertEqual(image_utils.get_jpeg_draft_scale((400, 300), None, 9), (None, True))
+        image = image_utils.decode_image(jpeg_bytes(), max_dimension=150, allow_downscale=True)
+        self.assertEqual(image.size, (150, 113))
+        self.assertEqual(image.info["downscaled_from"], (400, 300))
+
+
+@override_settings(METRICS_TOKEN="scraper-token", METRICS_ALLOWED_IPS=["10.0.0.5"])
+class FeatureMetricsAccessTests(SimpleTestCase):
+    def test_refused_without_token_or_allowed_address(self):
+        self.assertEqual(self.client.get(reverse("feature-metrics")).status_code, 403)
+        response = self.client.get(reverse("feature-metrics"), HTTP_AUTHORIZATION="Bearer wrong-token")
+        self.assertEqual(response.status_code, 403)
+
+    def test_served_to_the_scraper(self):
+        response = self.client.get(reverse("feature-metrics"), HTTP_AUTHORIZATION="Bearer scraper-token")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"# TYPE shugenai_feature_duration_seconds histogram", response.content)
+        self.assertEqual(self.client.get(reverse("feature-metrics"), REMOTE_ADDR="10.0.0.5").status_code, 200)
+
+
+def noisy_image(size=(128, 96)):
+    # Noise does not compress, every quality step changes the size
+    return Image.fromarray(np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8))
+
+
+class EncodeCompressedTests(SimpleTestCase):
+    def encoded_size(self, image, quality):
+        return len(image_utils.encode_bytes(image, "JPEG", quality=quality, progressive=True, optimize=True))
+
+    def test_highest_quality_within_the_target(self):
+        image = noisy_image()
+        target_size = self.encoded_size(image, 60)
+        options = image_utils.get_compression_options({"target_size": str(target_size)})
+        with mock.patch.object(image_utils, "encode_bytes", wraps=image_utils.encode_bytes) as encode_bytes:
+            output, info = image_utils.encode_compressed(image, options)
+        self.assertTrue(info["target_met"])
+        self.assertGreaterEqual(info["quality"], 60)
+        self.assertEqual(info["size"], len(output.read()))
+        self.assertLessEqual(info["size"], target_size)
+        # The next quality up was tried and did not fit
+        self.assertGreater(self.encoded_size(image, info["quality"] + 1), target_size)
+        # One encode at the top of the range, then a bisection of 1..95
+        self.assertLessEqual(encode_bytes.call_count, 1 + 7)
+
+    def test_quality_floor_wins_over_the_target(self):
+        options = image_utils.get_compression_options({"target_size": "100", "min_quality": "20"})
+        _, info = image_utils.encode_compressed(noisy_image(), options)
+        self.assertEqual(info["quality"], 20)
+        self.assertFalse(info["target_met"])
+
+    def test_fixed_quality_without_target(self):
+        options = image_utils.get_compression_options({"compression_quality": "70"})
+        _, info = image_utils.encode_compressed(noisy_image(), options)
+        self.assertEqual(info["quality"], 70)
+        self.assertTrue(info["target_met"])
+
+
+class ExactPaletteTests(SimpleTestCase):
+    def sticker(self):
+        pixels = np.zeros((40, 60, 4), np.uint8)
+        pixels[10:30, 10:50] = (230, 60, 40, 255)
+        pixels[15:25, 20:30] = (40, 90, 230, 128)
+        return Image.fromarray(pixels, "RGBA")
+
+    def test_rgba_round_trip(self):
+        image = self.sticker()
+        palette_image = image_utils.to_exact_palette(image)
+        self.assertEqual(palette_image.mode, "P")
+        self.assertEqual(palette_image.convert("RGBA").tobytes(), image.tobytes())
+
+    def test_rgb_round_trip_without_transparency(self):
+        image = self.sticker().convert("RGB")
+        palette_image = image_utils.to_exact_palette(image)
+        self.assertEqual(palette_image.convert("RGB").tobytes(), image.tobytes())
+        buffer = BytesIO()
+        palette_image.save(buffer, format="PNG")
+        self.assertNotIn("transparency", Image.open(BytesIO(buffer.getvalue())).info)
+
+    def test_photos_are_left_alone(self):
+        self.assertIsNone(image_utils.to_exact_palette(noisy_image()))
+
+    def test_png_output_is_lossless(self):
+        image = self.sticker()
+        output = image_utils.encode_transparent(image, "sticker.png")
+        decoded = Image.open(output)
+        self.assertEqual(decoded.mode, "P")
+        self.assertEqual(decoded.convert("RGBA").tobytes(), image.tobytes())
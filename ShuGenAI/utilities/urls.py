@@ -1,6 +1,8 @@
 from django.urls import path
-from .views import UserFeatureStatsView
+from .views import UserFeatureStatsView, DailyFeatureStatsView, feature_metrics
 
 urlpatterns = [
     path('stats/', UserFeatureStatsView.as_view(), name='user-feature-stats'),
+    path('stats/daily/', DailyFeatureStatsView.as_view(), name='daily-feature-stats'),
+    path('metrics/', feature_metrics, name='feature-metrics'),
 ]
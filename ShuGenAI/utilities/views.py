@@ -1,48 +1,106 @@
+import hmac
+from datetime import timedelta
+
+from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
-from django.db.models import Count
-from features.models import History, Feature
-from users.models import User
-
+from django.db.models import Sum
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from features import rollups
+from features.models import Feature
+from features.usage import pending_counts
+from . import metrics
 
-TEXT_FEATURE_KEYS = ['generate_summary','rewrite_text', 'essay_writer', 'paragraph_writer', 'grammar_checker', 'post_writer', 'document_code']  # Replace with your actual keys
-IMAGE_FEATURE_KEYS = ['black_and_white','round_image', "pixelate_image", 'blur_image', 'compress_image', 'remove_background', 'edit_background', 'cut_out_object']  # Replace with your actual keys
-FILE_FEATURE_KEYS = ['pdf_to_docx','heif_to_jpg', 'png_to_jpg', 'raw_to_jpg', 'tiff_to_jpg', 'xml_to_json', 'xml_to_json', 'json_to_xml', 'xls_to_csv', 'xls_to_json', 'xls_to_xml', 'docx_to_pdf', 'compress_pdf', 'mp4_to_gif', 'mkv_to_mp4', 'mp4_to_mp3', 'compress_mp4']  # Replace with your actual keys
+# Longest range served by the daily stats, and the one used without date_from
+MAX_DAILY_STATS_DAYS = 366
+DEFAULT_DAILY_STATS_DAYS = 30
 
 
 class UserFeatureStatsView(APIView):
     permission_classes = [AllowAny]  # Ensure user is authenticated
 
     def get(self, request):
+        # Optional ?date_from=YYYY-MM-DD &date_to=YYYY-MM-DD, both included, restrict the usage counts
+        try:
+            date_from = parse_stats_date(request.query_params.get('date_from'))
+            date_to = parse_stats_date(request.query_params.get('date_to'))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         # Count of users
-        user_count = User.objects.count()
+        user_count = rollups.user_count()
 
         # Count of used features
         total_feature_count = Feature.objects.count()
 
-        # Count used text features
-        text_usage_count = History.objects.filter(
-            feature__key__in=TEXT_FEATURE_KEYS
-        ).count()
-
-        # Count used image features
-        image_usage_count = History.objects.filter(
-            feature__key__in=IMAGE_FEATURE_KEYS
-        ).count()
+        # Calls per category, read from the daily rollups instead of the history
+        category_usage = rollups.usage_by_category(date_from, date_to)
 
-        # Count used file features
-        file_usage_count = History.objects.filter(
-            feature__key__in=FILE_FEATURE_KEYS
-        ).count()
+        # Total number of feature calls, including the ones this process has not flushed yet
+        total_usage_count = (Feature.objects.aggregate(total=Sum('used_count'))['total'] or 0) \
+            + sum(pending_counts().values())
 
         # Prepare the response data
         response_data = {
             'user_count': user_count,
-            'text_feature_count': text_usage_count,
-            'image_feature_count': image_usage_count,
-            'file_feature_count': file_usage_count,
+            'text_feature_count': category_usage[Feature.CATEGORY_TEXT],
+            'image_feature_count': category_usage[Feature.CATEGORY_IMAGE],
+            'file_feature_count': category_usage[Feature.CATEGORY_FILE],
             'total_feature_count': total_feature_count,
+            'total_usage_count': total_usage_count,
         }
 
         return Response(response_data)
+
+
+class DailyFeatureStatsView(APIView):
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        # ?date_from=YYYY-MM-DD &date_to=YYYY-MM-DD, the last 30 days by default
+        try:
+            date_to = parse_stats_date(request.query_params.get('date_to')) or timezone.localdate()
+            date_from = parse_stats_date(request.query_params.get('date_from')) \
+                or date_to - timedelta(days=DEFAULT_DAILY_STATS_DAYS - 1)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if date_from > date_to:
+            return Response({"error": "date_from is after date_to"}, status=status.HTTP_400_BAD_REQUEST)
+        if (date_to - date_from).days >= MAX_DAILY_STATS_DAYS:
+            return Response({"error": f"The range can not be longer than {MAX_DAILY_STATS_DAYS} days"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'date_from': date_from,
+            'date_to': date_to,
+            'days': rollups.daily_usage(date_from, date_to),
+        })
+
+
+def parse_stats_date(value):
+    if not value:
+        return None
+    parsed = parse_date(value)
+    if parsed is None:
+        raise ValueError(f"Invalid date: {value}")
+    return parsed
+
+
+def metrics_allowed(request):
+    # The bearer token of the scraper, or an address of the allow-list (see METRICS_TOKEN in settings.py)
+    if settings.METRICS_TOKEN:
+        expected = f"Bearer {settings.METRICS_TOKEN}".encode("utf-8")
+        if hmac.compare_digest(request.headers.get("Authorization", "").encode("utf-8"), expected):
+            return True
+    return request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS
+
+
+def feature_metrics(request):
+    # Prometheus scrape target; the histograms cover the requests served by this process only
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")